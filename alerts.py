@@ -0,0 +1,218 @@
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import fx
+import models
+
+# Percent of the monthly budget at which an alert is recorded
+THRESHOLDS = (80, 100)
+
+MAX_TRACKED_MONTHS = 10_000
+MAX_TRACKED_USERS = 10_000
+
+
+class _MonthState:
+    """Running spend for one (user, year, month), kept per process.
+
+    Amounts are held in the budget's currency (the base currency when the
+    month has no budget).
+    """
+
+    __slots__ = ("version", "amounts", "total", "budget", "currency", "fired")
+
+    def __init__(self, version, amounts, budget, currency, fired):
+        self.version = version
+        self.amounts = amounts  # expense_id -> amount, so re-applying a write is harmless
+        self.total = sum(amounts.values())
+        self.budget = budget
+        self.currency = currency
+        self.fired = fired
+
+    def put(self, expense_id, amount):
+        self.total += amount - self.amounts.get(expense_id, 0)
+        self.amounts[expense_id] = amount
+
+    def remove(self, expense_id):
+        self.total -= self.amounts.pop(expense_id, 0)
+
+
+_states = OrderedDict()  # (user_id, year, month) -> _MonthState
+_lock = threading.Lock()
+
+# user_id -> (base, head): this process applied every write of the user from
+# version base + 1 through head, so a month loaded at version >= base and
+# patched along the way is still exact at head. A write to one month then
+# leaves the user's other months valid instead of forcing them to reload.
+_chains = OrderedDict()
+
+
+def _advance(user_id, version):
+    """Record write `version`; False when writes were missed (made by another worker)"""
+    chain = _chains.get(user_id)
+    if chain is not None and chain[1] in (version, version - 1):
+        _chains[user_id] = (chain[0], version)
+        _chains.move_to_end(user_id)
+        return True
+    if chain is None or version > chain[1]:
+        _chains[user_id] = (version, version)
+        _chains.move_to_end(user_id)
+        while len(_chains) > MAX_TRACKED_USERS:
+            _chains.popitem(last=False)
+    return False
+
+
+def _current(user_id, state, version):
+    """Whether `state` reflects every write of the user up to `version`"""
+    chain = _chains.get(user_id)
+    return chain is not None and chain[1] == version and state.version >= chain[0]
+
+
+def _month_bounds(year, month):
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start, end
+
+
+def _load(db: Session, user_id, year, month, version):
+    """Seed a month from the database (one indexed range scan, no ORM objects)"""
+    start, end = _month_bounds(year, month)
+    budget, currency = db.query(models.Budget.amount, models.Budget.currency)\
+        .filter(
+            models.Budget.user_id == user_id,
+            models.Budget.year == year,
+            models.Budget.month == start.strftime("%B")
+        )\
+        .first() or (None, fx.BASE_CURRENCY)
+    rows = db.query(models.Expense.id, models.Expense.currency, models.Expense.date, models.Expense.amount)\
+        .filter(
+            models.Expense.user_id == user_id,
+            models.Expense.date >= start,
+            models.Expense.date < end,
+            models.Expense.deleted_at.is_(None)
+        )\
+        .all()
+    amounts = fx.get_rates().convert_grouped(rows, currency)
+    fired = {
+        threshold for (threshold,) in db.query(models.BudgetAlert.threshold)
+        .filter(
+            models.BudgetAlert.user_id == user_id,
+            models.BudgetAlert.year == year,
+            models.BudgetAlert.month == month
+        )
+    }
+    return _MonthState(version, amounts, budget, currency, fired)
+
+
+def _store(key, state):
+    with _lock:
+        # A load sees every write so far; older states of the user can no longer be vouched for
+        chain = _chains.get(key[0])
+        if chain is None or chain[1] < state.version:
+            _chains[key[0]] = (state.version, state.version)
+            _chains.move_to_end(key[0])
+            while len(_chains) > MAX_TRACKED_USERS:
+                _chains.popitem(last=False)
+        _states[key] = state
+        _states.move_to_end(key)
+        while len(_states) > MAX_TRACKED_MONTHS:
+            _states.popitem(last=False)
+
+
+def _fire(db: Session, user_id, year, month, state):
+    if not state.budget:
+        return
+    for threshold in THRESHOLDS:
+        if threshold in state.fired or state.total < state.budget * threshold / 100:
+            continue
+        state.fired.add(threshold)
+        db.add(models.BudgetAlert(
+            user_id=user_id, year=year, month=month, threshold=threshold,
+            spent=state.total, budget=state.budget, currency=state.currency,
+            created_at=datetime.utcnow()
+        ))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Already recorded by another worker
+            db.rollback()
+
+
+def expense_written(db: Session, user_id: int, version: int, before=None, after=None):
+    """Apply one committed expense write to the running totals and fire thresholds.
+
+    `before`/`after` are crud.ExpenseSnapshot tuples for the row as it
+    was and as it is now (None for inserts/deletes). `version` is the user's
+    version returned by cache.user_changed for this write. When this process
+    saw the user's previous write too, loaded months are patched in O(1)
+    and the user's other months stay valid; after a write by another worker
+    the touched months are reloaded.
+    """
+    months = {(row.date.year, row.date.month) for row in (before, after) if row is not None}
+    with _lock:
+        chain = _chains.get(user_id)
+        base = chain[0] if chain is not None else None
+        continued = _advance(user_id, version)
+    for year, month in months:
+        key = (user_id, year, month)
+        with _lock:
+            state = _states.get(key)
+            if state is not None and continued and state.version >= base:
+                if before is not None:
+                    state.remove(before.id)
+                if after is not None and (after.date.year, after.date.month) == (year, month):
+                    factor = fx.get_rates().factors(after.currency, state.currency, [after.date])[0]
+                    state.put(after.id, after.amount * factor)
+                state.version = version
+                _states.move_to_end(key)
+            else:
+                state = None
+        if state is None:
+            state = _load(db, user_id, year, month, version)
+            _store(key, state)
+        _fire(db, user_id, year, month, state)
+
+
+def budget_written(db: Session, user_id: int, version: int, budget: models.Budget):
+    """Re-evaluate the thresholds of a month whose budget was created or changed"""
+    month_changed(db, user_id, version, budget.year, datetime.strptime(budget.month, "%B").month)
+
+
+def month_changed(db: Session, user_id: int, version: int, year: int, month: int):
+    """Reload a month after a bulk write and fire any threshold it now crosses"""
+    with _lock:
+        _advance(user_id, version)
+    state = _load(db, user_id, year, month, version)
+    _store((user_id, year, month), state)
+    _fire(db, user_id, year, month, state)
+
+
+def month_status(db: Session, user_id: int, version: int, year: int, month: int):
+    """Spent vs budget for a month, from the running state when it is current"""
+    key = (user_id, year, month)
+    with _lock:
+        state = _states.get(key)
+        if state is not None and not _current(user_id, state, version):
+            state = None
+    if state is None:
+        state = _load(db, user_id, year, month, version)
+        _store(key, state)
+    return {
+        "year": year,
+        "month": month,
+        "spent": state.total,
+        "budget": state.budget,
+        "currency": state.currency,
+        "percent": round(state.total * 100 / state.budget, 1) if state.budget else None,
+    }
+
+
+def recent_alerts(db: Session, user_id: int, limit: int = 10):
+    return db.query(models.BudgetAlert)\
+        .filter(models.BudgetAlert.user_id == user_id)\
+        .order_by(models.BudgetAlert.created_at.desc())\
+        .limit(limit)\
+        .all()
@@ -0,0 +1,190 @@
+"""Month-end spend forecasts and unusual-spending flags for the budget page.
+
+Each user's history is held as one dense NumPy array of daily totals in
+the base currency, loaded with a single column-only query and patched in
+place by crud's write hooks. Forecasts and
+anomalies are computed from that array with vectorized cumulative sums
+and cached per month until a write lands inside the month's window.
+"""
+import threading
+from datetime import date
+
+from sqlalchemy.orm import Session
+
+import cache
+import fx
+import models
+
+# Days before each day whose totals form its rolling mean and deviation
+WINDOW_DAYS = 28
+
+# Standard deviations above the rolling mean at which a day is unusual
+Z_THRESHOLD = 3.0
+
+# Sparse histories make every purchase an outlier; require this many spending days in the window
+MIN_ACTIVE_DAYS = 5
+
+MAX_TRACKED_USERS = 1_000
+
+
+def _month_range(year: int, month: int):
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start.toordinal(), end.toordinal()
+
+
+class _DailySeries:
+    """Daily spend of one user for the ordinals [first, first + len(daily))"""
+
+    __slots__ = ("version", "lock", "first", "daily", "amounts", "outlooks")
+
+    def __init__(self, version, first, daily, amounts):
+        self.version = version
+        self.lock = threading.Lock()
+        self.first = first
+        self.daily = daily
+        # expense id -> (ordinal, base-currency amount) of what `daily` holds for it, so a
+        # write the load already saw replaces its own amount instead of being counted twice
+        self.amounts = amounts
+        self.outlooks = {}  # (year, month) -> (today, outlook in the base currency)
+
+    def covers(self, first, end):
+        return self.first <= first and end <= self.first + len(self.daily)
+
+    def _touch(self, ordinal):
+        """Forget the outlooks whose window includes the day"""
+        for key in [key for key in self.outlooks if self._in_window(key, ordinal)]:
+            del self.outlooks[key]
+
+    def remove(self, expense_id):
+        entry = self.amounts.pop(expense_id, None)
+        if entry is not None:
+            self.daily[entry[0] - self.first] -= entry[1]
+            self._touch(entry[0])
+
+    def put(self, expense_id, day: date, amount: float):
+        """Set one expense's base-currency amount, replacing whatever it counted before"""
+        self.remove(expense_id)
+        ordinal = day.toordinal()
+        if self.first <= ordinal < self.first + len(self.daily):
+            self.amounts[expense_id] = (ordinal, amount)
+            self.daily[ordinal - self.first] += amount
+        self._touch(ordinal)
+
+    @staticmethod
+    def _in_window(key, ordinal):
+        start, end = _month_range(*key)
+        return start - WINDOW_DAYS <= ordinal < end
+
+    def outlook(self, year: int, month: int, today: date):
+        cached = self.outlooks.get((year, month))
+        if cached is not None and cached[0] == today:
+            return cached[1]
+        import numpy as np
+        start, end = _month_range(year, month)
+        x = self.daily[start - WINDOW_DAYS - self.first:end - self.first]
+
+        # Rolling sums over the WINDOW_DAYS before each day of the month, from prefix sums
+        sums = np.concatenate(([0.0], np.cumsum(x)))
+        squares = np.concatenate(([0.0], np.cumsum(x * x)))
+        active = np.concatenate(([0], np.cumsum(x > 0)))
+        days = np.arange(WINDOW_DAYS, len(x))
+        mean = (sums[days] - sums[days - WINDOW_DAYS]) / WINDOW_DAYS
+        variance = (squares[days] - squares[days - WINDOW_DAYS]) / WINDOW_DAYS - mean * mean
+        std = np.sqrt(np.clip(variance, 0, None))
+        spent = x[WINDOW_DAYS:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (spent - mean) / std
+        unusual = np.flatnonzero(
+            (std > 0) & (active[days] - active[days - WINDOW_DAYS] >= MIN_ACTIVE_DAYS) & (z >= Z_THRESHOLD)
+        )
+
+        total = float(spent.sum())
+        elapsed = today.toordinal() - start + 1
+        if elapsed <= 0:
+            projected = None
+        elif elapsed >= len(spent):
+            projected = total
+        else:
+            # Run rate of the days so far, plus anything already dated later this month
+            projected = total + float(spent[:elapsed].sum()) / elapsed * (len(spent) - elapsed)
+
+        result = {
+            "projected": projected,
+            "anomalies": [(date.fromordinal(start + i), float(spent[i]), float(z[i])) for i in unusual],
+        }
+        self.outlooks[(year, month)] = (today, result)
+        return result
+
+
+_series = cache.UserStates(maxsize=MAX_TRACKED_USERS)
+
+
+def _load(db: Session, user_id: int, version: int, first: int, end: int):
+    """Daily base-currency totals for [first, end) from one column-only query"""
+    import numpy as np  # imported on first use to keep app startup fast
+    rows = db.query(models.Expense.id, models.Expense.date, models.Expense.currency, models.Expense.amount)\
+        .filter(
+            models.Expense.user_id == user_id,
+            models.Expense.date >= date.fromordinal(first),
+            models.Expense.date < date.fromordinal(end),
+            models.Expense.deleted_at.is_(None)
+        )\
+        .all()
+    daily = np.zeros(end - first)
+    amounts = {}
+    by_currency = {}
+    for row in rows:
+        by_currency.setdefault(row.currency, []).append(row)
+    rates = fx.get_rates()
+    for currency, group in by_currency.items():
+        days = [row.date for row in group]
+        factors = rates.factors(currency, fx.BASE_CURRENCY, days)
+        converted = np.fromiter((row.amount for row in group), np.float64, len(group)) * np.asarray(factors)
+        ordinals = np.fromiter((d.toordinal() for d in days), np.int64, len(group))
+        np.add.at(daily, ordinals - first, converted)
+        amounts.update(zip((row.id for row in group), zip(ordinals.tolist(), converted.tolist())))
+    return _DailySeries(version, first, daily, amounts)
+
+
+def get_outlooks(db: Session, user_id: int, version: int, months, today: date, currency: str = fx.BASE_CURRENCY):
+    """{(year, month): {"projected", "anomalies"}} in `currency` for each requested month.
+
+    "projected" is the month-end spend at the month's run rate so far (the
+    actual total for past months, None for future ones); "anomalies" are
+    (day, amount, z-score) for days far above the preceding weeks.
+    """
+    months = sorted(set(months))
+    if not months:
+        return {}
+    first = _month_range(*months[0])[0] - WINDOW_DAYS
+    end = _month_range(*months[-1])[1]
+    series = _series.get(user_id, version)
+    if series is None or not series.covers(first, end):
+        series = _load(db, user_id, version, first, end)
+        _series.put(user_id, series)
+    with series.lock:
+        base = {key: series.outlook(*key, today) for key in months}
+
+    rates = fx.get_rates()
+    outlooks = {}
+    for (year, month), result in base.items():
+        # Same rate as the budget amounts it is shown next to (crud._budget_amount)
+        factor = rates.factors(fx.BASE_CURRENCY, currency, [date(year, month, 1)])[0]
+        outlooks[(year, month)] = {
+            "projected": result["projected"] * factor if result["projected"] is not None else None,
+            "anomalies": [(day, amount * factor, z) for day, amount, z in result["anomalies"]],
+        }
+    return outlooks
+
+
+def _patch(series, before, after):
+    if after is None:
+        series.remove(before.id)
+        return
+    factor = fx.get_rates().factors(after.currency, fx.BASE_CURRENCY, [after.date])[0]
+    series.put(after.id, after.date, after.amount * factor)
+
+
+def expense_written(user_id: int, version: int, before=None, after=None):
+    _series.patch(user_id, version, lambda series: _patch(series, before, after))
@@ -0,0 +1,94 @@
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import crud
+import models
+import scheduler
+
+# Expenses dated more than this many days ago leave the hot expenses table
+HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "730"))
+
+# Rows moved per transaction
+BATCH_SIZE = 500
+
+_COLUMNS = ("id", "user_id", "amount", "category_id", "currency", "date", "description", "recurring_id", "deleted_at")
+
+
+def _add_to_rollups(db: Session, sums):
+    """Fold {(user_id, year, month, category_id, currency): (total, count)} into expense_rollups"""
+    if not sums:
+        return
+    existing = {
+        (r.user_id, r.year, r.month, r.category_id, r.currency): r
+        for r in db.query(models.ExpenseRollup).filter(
+            models.ExpenseRollup.user_id.in_({key[0] for key in sums}),
+            models.ExpenseRollup.year.in_({key[1] for key in sums})
+        ).with_for_update()
+    }
+    for key, (total, count) in sums.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            user_id, year, month, category_id, currency = key
+            db.add(models.ExpenseRollup(
+                user_id=user_id, year=year, month=month, category_id=category_id,
+                currency=currency, total=total, count=count
+            ))
+        else:
+            rollup.total += total
+            rollup.count += count
+
+
+def archive_before(db: Session, cutoff: date):
+    """Move expenses dated before `cutoff` to expenses_archive; returns the number moved.
+
+    Each batch copies the rows, adds the live ones to the monthly rollups
+    and deletes them from expenses in one transaction, so a crash or a
+    concurrent worker (rows are locked with SKIP LOCKED) never counts a
+    row twice. Soft-deleted rows are archived but left out of the rollups.
+    """
+    moved, conflicts = 0, 0
+    while True:
+        rows = db.query(*(getattr(models.Expense, column) for column in _COLUMNS))\
+            .filter(models.Expense.date < cutoff)\
+            .order_by(models.Expense.id)\
+            .limit(BATCH_SIZE)\
+            .with_for_update(skip_locked=True)\
+            .all()
+        if not rows:
+            return moved
+
+        archived_at = datetime.utcnow()
+        sums = {}
+        for row in rows:
+            if row.deleted_at is None:
+                key = (row.user_id, row.date.year, row.date.month, row.category_id, row.currency)
+                total, count = sums.get(key, (0, 0))
+                sums[key] = (total + row.amount, count + 1)
+        try:
+            db.execute(insert(models.ExpenseArchive), [
+                {**row._asdict(), "archived_at": archived_at} for row in rows
+            ])
+            _add_to_rollups(db, sums)
+            db.query(models.Expense)\
+                .filter(models.Expense.id.in_([row.id for row in rows]))\
+                .delete(synchronize_session=False)
+            db.commit()
+        except IntegrityError:
+            # Another worker created the same rollup row first; retry the batch
+            db.rollback()
+            conflicts += 1
+            if conflicts > 3:
+                raise
+            continue
+        moved += len(rows)
+        for user_id in {row.user_id for row in rows}:
+            crud.expenses_bulk_written(db, user_id, ())
+
+
+@scheduler.job("expense_archival", interval=24 * 3600)
+def archive_job(db: Session):
+    return archive_before(db, date.today() - timedelta(days=HORIZON_DAYS))
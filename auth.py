@@ -1,12 +1,28 @@
 from fastapi import Request, Form, Depends
 from fastapi.responses import RedirectResponse
 from sqlalchemy.orm import Session
-from database import SessionLocal
+from database import open_session, shard_for
 import crud
 import models
 
-def get_db():
-    db = SessionLocal()
+def get_db(request: Request):
+    """Session on the logged-in user's shard (the primary for anonymous requests)"""
+    user_id = request.session.get("user_id")
+    db = open_session(shard_for(user_id) if user_id else 0)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_session_factory(request: Request):
+    """Opens more sessions on the logged-in user's shard, for work running beside the request's own"""
+    user_id = request.session.get("user_id")
+    shard = shard_for(user_id) if user_id else 0
+    return lambda: open_session(shard)
+
+def get_primary_db():
+    """Session on the primary shard, which holds every users row (login, registration)"""
+    db = open_session(0)
     try:
         yield db
     finally:
@@ -0,0 +1,66 @@
+"""Import-time budget for the app: `python bench_startup.py`.
+
+Imports `main` in fresh interpreters with `-X importtime`, keeps the best of
+a few runs and fails (exit 1) if the app's own modules go over budget or if
+a module that should load lazily shows up at import time.
+"""
+import argparse
+import subprocess
+import sys
+
+# Cumulative import time budgets in milliseconds (best of --runs). "main" is
+# about 1.25x its measured ~450ms, tight enough to catch one heavy import.
+BUDGETS_MS = {
+    "main": 560,
+    "crud": 60,
+    "models": 60,
+    "database": 40,
+    "sessions": 20,
+    "cache": 10,
+    "auth": 10,
+}
+
+# Must not be imported until first use (DB driver, hashing, templates, array math)
+LAZY_MODULES = ["pymysql", "passlib.hash", "jinja2", "numpy"]
+
+def measure():
+    """Return {module: cumulative microseconds} for one cold `import main`"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True, check=True,
+    )
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = int(cumulative)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    best = {}
+    for _ in range(args.runs):
+        for name, micros in measure().items():
+            best[name] = min(micros, best.get(name, micros))
+
+    failures = []
+    print(f"{'module':<12} {'ms':>8} {'budget':>8}")
+    for name, budget in BUDGETS_MS.items():
+        took = best.get(name, 0) / 1000
+        print(f"{name:<12} {took:>8.1f} {budget:>8}")
+        if took > budget:
+            failures.append(f"{name} took {took:.1f}ms (budget {budget}ms)")
+    for name in LAZY_MODULES:
+        if name in best:
+            failures.append(f"{name} is imported eagerly")
+
+    for failure in failures:
+        print("FAIL:", failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
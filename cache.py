@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# ---------------------- VERSION COUNTERS ----------------------
+class LocalVersions:
+    """Per-user data versions for a single process"""
+
+    # Whether bumps made by other processes (workers, admin scripts) are seen here
+    shared = False
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> int:
+        return self._versions.get(user_id, 0)
+
+    def get_many(self, user_ids) -> dict:
+        return {user_id: self._versions.get(user_id, 0) for user_id in user_ids}
+
+    def bump(self, user_id: int) -> int:
+        with self._lock:
+            version = self._versions.get(user_id, 0) + 1
+            self._versions[user_id] = version
+            return version
+
+    def close(self):
+        pass
+
+
+class SQLiteVersions(LocalVersions):
+    """Per-user data versions shared by every worker through a SQLite file.
+
+    A write in any worker bumps the user's counter; every cached value is
+    stamped with the version it was computed at, so the next read in any
+    other worker sees the mismatch and recomputes. Reads are a single
+    primary-key lookup on a local file.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_versions ("
+            "user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM user_versions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def get_many(self, user_ids):
+        user_ids = list(user_ids)
+        found = {}
+        with self._lock:
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                found.update(self._conn.execute(
+                    f"SELECT user_id, version FROM user_versions WHERE user_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall())
+        return {user_id: found.get(user_id, 0) for user_id in user_ids}
+
+    def bump(self, user_id):
+        with self._lock:
+            return self._conn.execute(
+                "INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+                "ON CONFLICT(user_id) DO UPDATE SET version = version + 1 "
+                "RETURNING version",
+                (user_id,),
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_versions():
+    """Use the shared SQLite counter when CACHE_VERSIONS_PATH is set (multi-worker mode)"""
+    path = os.getenv("CACHE_VERSIONS_PATH")
+    if path:
+        return SQLiteVersions(path)
+    return LocalVersions()
+
+
+versions = create_versions()
+
+# ---------------------- PER-USER CACHE ----------------------
+_MISSING = object()
+
+
+class UserCache:
+    """Bounded LRU of per-user values, invalidated through `versions`"""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (user_id, key) -> (version, value)
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, user_id: int, key, compute):
+        version = versions.get(user_id)
+        with self._lock:
+            entry = self._entries.get((user_id, key), _MISSING)
+            if entry is not _MISSING and entry[0] == version:
+                self._entries.move_to_end((user_id, key))
+                return entry[1]
+        value = compute()
+        with self._lock:
+            self._entries[(user_id, key)] = (version, value)
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def user_changed(user_id: int) -> int:
+    """Invalidate every cached value of a user in all workers; call after commit"""
+    return versions.bump(user_id)
+
+
+# ---------------------- PATCHED STATE ----------------------
+class UserStates:
+    """Bounded LRU of per-user state that crud's write hooks patch in place.
+
+    Each state has a `version` (the user's version it reflects) and a
+    `lock`, held while the state is patched and while it is read. A write
+    patches a state exactly one version behind; any other state missed a
+    write made in another worker and is dropped, to be reloaded on next use.
+    Bounded by entry count, or by the bytes `sizeof(state)` reports.
+    """
+
+    def __init__(self, maxsize: int = None, maxbytes: int = None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self._states = OrderedDict()  # user_id -> state, least recently used first
+        self._sizes = {}  # user_id -> bytes counted for its state
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, user_id: int, version: int):
+        """The user's state if it is at `version`, else None"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None or state.version != version:
+                return None
+            self._states.move_to_end(user_id)
+            return state
+
+    def put(self, user_id: int, state):
+        """Keep a freshly loaded state unless a newer one is already there"""
+        with self._lock:
+            current = self._states.get(user_id)
+            if current is not None and current.version > state.version:
+                return
+            self._states[user_id] = state
+            self._states.move_to_end(user_id)
+            self._resize(user_id, state)
+
+    def patch(self, user_id: int, version: int, apply):
+        """Run `apply(state)` for the committed write that made `version`"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                return
+            if state.version != version - 1:
+                self._forget(user_id)
+                return
+            with state.lock:
+                apply(state)
+                state.version = version
+            self._resize(user_id, state)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def _forget(self, user_id):
+        self._states.pop(user_id, None)
+        self.total_bytes -= self._sizes.pop(user_id, 0)
+
+    def _resize(self, user_id, state):
+        if self.sizeof is not None:
+            nbytes = self.sizeof(state)
+            self.total_bytes += nbytes - self._sizes.get(user_id, 0)
+            self._sizes[user_id] = nbytes
+        while self._states and (
+            (self.maxsize is not None and len(self._states) > self.maxsize)
+            or (self.maxbytes is not None and self.total_bytes > self.maxbytes)
+        ):
+            self._forget(next(iter(self._states)))
+
+
+# ---------------------- RECENT KEYS ----------------------
+class RecentKeys:
+    """Values remembered for `ttl` seconds, e.g. the result of an idempotent write.
+
+    Every entry lives equally long, so insertion order is expiry order and
+    expired entries are dropped from the front of the dict on each write.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[0] > now and len(self._entries) <= self.maxsize:
+                    break
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,116 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, aliased
+
+import database
+import models
+import scheduler
+
+# Superseded entries older than this are removed by the compaction job
+RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+
+COMPACT_BATCH_SIZE = 1000
+
+
+def expense_data(expense):
+    return {
+        "date": expense.date.isoformat(),
+        "amount": expense.amount,
+        "currency": expense.currency,
+        "category_id": expense.category_id,
+        "description": expense.description,
+    }
+
+
+def budget_data(budget: models.Budget):
+    return {"month": budget.month, "year": budget.year, "amount": budget.amount, "currency": budget.currency}
+
+
+# ---------------------- WRITING ----------------------
+def log_changes(db: Session, user_id: int, changes):
+    """Insert (entity, entity_id, op, data) entries into the caller's open transaction.
+
+    The user's row is locked first, so one user's entries commit in seq
+    order and a client that resumes from the last seq it saw cannot skip
+    an entry that was still uncommitted when it last read. The same lock
+    serializes writes with shards.move_user.
+    """
+    db.query(models.User.id).filter(models.User.id == user_id).with_for_update().one()
+    # A move to another shard commits while holding this lock; refuse stale-routed writes
+    database.check_shard(db, user_id)
+    insert_changes(db, user_id, changes)
+
+
+def insert_changes(db: Session, user_id: int, changes):
+    """log_changes without the lock, for callers that already own every row of the user"""
+    now = datetime.utcnow()
+    rows = [
+        {
+            "user_id": user_id, "entity": entity, "entity_id": entity_id, "op": op,
+            "data": json.dumps(data, separators=(",", ":")) if data is not None else None,
+            "created_at": now,
+        }
+        for entity, entity_id, op, data in changes
+    ]
+    if rows:
+        db.execute(insert(models.ChangeLog), rows)
+
+
+# ---------------------- READING ----------------------
+def get_changes(db: Session, user_id: int, since: int = 0, limit: int = 500):
+    """Entries after `since` in seq order, as plain dicts"""
+    entries = db.query(models.ChangeLog)\
+        .filter(models.ChangeLog.user_id == user_id, models.ChangeLog.seq > since)\
+        .order_by(models.ChangeLog.seq)\
+        .limit(limit)\
+        .all()
+    return [
+        {
+            "seq": entry.seq,
+            "entity": entry.entity,
+            "id": entry.entity_id,
+            "op": entry.op,
+            "data": json.loads(entry.data) if entry.data is not None else None,
+        }
+        for entry in entries
+    ]
+
+
+# ---------------------- COMPACTION ----------------------
+def compact(db: Session, before: datetime):
+    """Delete entries older than `before` that a later entry for the same row supersedes.
+
+    The latest entry of every row (including delete tombstones) is kept,
+    so a client resuming from any seq still converges on the current
+    state; the table stays bounded by the number of rows ever written.
+    """
+    newer = aliased(models.ChangeLog)
+    removed = 0
+    while True:
+        seqs = [
+            seq for (seq,) in db.query(models.ChangeLog.seq)
+            .filter(
+                models.ChangeLog.created_at < before,
+                db.query(newer.seq).filter(
+                    newer.entity == models.ChangeLog.entity,
+                    newer.entity_id == models.ChangeLog.entity_id,
+                    newer.seq > models.ChangeLog.seq
+                ).exists()
+            )
+            .limit(COMPACT_BATCH_SIZE)
+        ]
+        if not seqs:
+            return removed
+        db.query(models.ChangeLog)\
+            .filter(models.ChangeLog.seq.in_(seqs))\
+            .delete(synchronize_session=False)
+        db.commit()
+        removed += len(seqs)
+
+
+@scheduler.job("change_log_compaction", interval=24 * 3600)
+def compact_job(db: Session):
+    return compact(db, datetime.utcnow() - timedelta(days=RETENTION_DAYS))
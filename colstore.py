@@ -0,0 +1,234 @@
+"""Per-user expense columns kept in memory for the users who read the most.
+
+A user's live expenses are loaded once into NumPy arrays (ids, date
+ordinals, months, float64 amounts, small-int codes for categories and
+currencies) and patched in place by crud's write hooks. Listing a month or
+totalling it per category is then array filtering and np.bincount, with no
+query and no ORM objects. A user gets a store on their
+EXPENSE_STORE_ADMIT_READS-th read, so one-off visitors never cost a full
+load. Stores are evicted least recently used once their combined size
+passes EXPENSE_STORE_MB; 0 turns the store off. Without a store crud
+falls back to the database.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import date
+
+from sqlalchemy.orm import Session
+
+import cache
+import fx
+import models
+
+MAX_BYTES = int(float(os.getenv("EXPENSE_STORE_MB", "64")) * 1024 * 1024)
+
+ADMIT_AFTER_READS = int(os.getenv("EXPENSE_STORE_ADMIT_READS", "3"))
+
+MAX_COUNTED_USERS = 10_000
+
+# Estimated Python-side cost of a row: id -> index dict entry, description string
+_ROW_OVERHEAD = 160
+
+_MIN_CAPACITY = 64
+
+# Column names and NumPy dtypes (as names, so numpy is only imported once a store is built)
+_COLUMNS = (
+    ("ids", "int64"), ("days", "int32"), ("months", "int8"),
+    ("amounts", "float64"), ("categories", "int16"), ("currencies", "int8"),
+)
+
+
+class ExpenseColumns:
+    """Live expenses of one user; row i of every column is one expense, in no particular order"""
+
+    def __init__(self, version, rows):
+        import numpy as np  # imported on first use to keep app startup fast
+        self.version = version
+        self.lock = threading.Lock()
+        self.size = len(rows)
+        self.category_ids = []  # code -> category id
+        self.currency_codes = []  # code -> ISO 4217 code
+        self._category_index = {}
+        self._currency_index = {}
+        capacity = max(_MIN_CAPACITY, self.size)
+        for name, dtype in _COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype))
+        n = self.size
+        self.ids[:n] = np.fromiter((row.id for row in rows), np.int64, n)
+        self.days[:n] = np.fromiter((row.date.toordinal() for row in rows), np.int32, n)
+        self.months[:n] = np.fromiter((row.date.month for row in rows), np.int8, n)
+        self.amounts[:n] = np.fromiter((row.amount for row in rows), np.float64, n)
+        self.categories[:n] = np.fromiter((self._category(row.category_id) for row in rows), np.int16, n)
+        self.currencies[:n] = np.fromiter((self._currency(row.currency) for row in rows), np.int8, n)
+        self.descriptions = [row.description for row in rows]
+        self._rows = {row.id: i for i, row in enumerate(rows)}  # expense id -> row index
+
+    def _category(self, category_id):
+        code = self._category_index.get(category_id)
+        if code is None:
+            code = self._category_index[category_id] = len(self.category_ids)
+            self.category_ids.append(category_id)
+        return code
+
+    def _currency(self, currency):
+        code = self._currency_index.get(currency)
+        if code is None:
+            code = self._currency_index[currency] = len(self.currency_codes)
+            self.currency_codes.append(currency)
+        return code
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name, _ in _COLUMNS) + self.size * _ROW_OVERHEAD
+
+    # ---------------------- PATCHING ----------------------
+    def put(self, row):
+        """Insert or overwrite one expense (a crud.ExpenseSnapshot)"""
+        import numpy as np
+        i = self._rows.get(row.id)
+        if i is None:
+            if self.size == len(self.ids):
+                for name, _ in _COLUMNS:
+                    column = getattr(self, name)
+                    grown = np.zeros(len(column) * 2, column.dtype)
+                    grown[:self.size] = column[:self.size]
+                    setattr(self, name, grown)
+            i = self._rows[row.id] = self.size
+            self.size += 1
+            self.descriptions.append(row.description)
+        else:
+            self.descriptions[i] = row.description
+        self.ids[i] = row.id
+        self.days[i] = row.date.toordinal()
+        self.months[i] = row.date.month
+        self.amounts[i] = row.amount
+        self.categories[i] = self._category(row.category_id)
+        self.currencies[i] = self._currency(row.currency)
+
+    def remove(self, expense_id):
+        """Drop one expense by moving the last row into its slot"""
+        i = self._rows.pop(expense_id, None)
+        if i is None:
+            return
+        last = self.size - 1
+        if i != last:
+            for name, _ in _COLUMNS:
+                column = getattr(self, name)
+                column[i] = column[last]
+            self.descriptions[i] = self.descriptions[last]
+            self._rows[int(self.ids[i])] = i
+        self.descriptions.pop()
+        self.size = last
+
+    # ---------------------- READING ----------------------
+    def _select(self, month=None):
+        import numpy as np
+        if month is None:
+            return np.arange(self.size)
+        return np.flatnonzero(self.months[:self.size] == month)
+
+    def rows(self, month: int = None):
+        """(id, date, amount, currency, category_id, description) tuples, newest first"""
+        import numpy as np
+        with self.lock:
+            selected = self._select(month)
+            selected = selected[np.lexsort((-self.ids[selected], -self.days[selected]))]
+            return [
+                (int(self.ids[i]), date.fromordinal(int(self.days[i])), float(self.amounts[i]),
+                 self.currency_codes[self.currencies[i]], self.category_ids[self.categories[i]],
+                 self.descriptions[i])
+                for i in selected
+            ]
+
+    def totals(self, target: str, month: int = None, by_month: bool = False):
+        """{category_id: total} (or {(month, category_id): total}) converted into `target`.
+
+        Rates are looked up once per currency and distinct day, like
+        fx.RateTable.convert_grouped does for grouped query rows.
+        """
+        import numpy as np
+        with self.lock:
+            selected = self._select(month)
+            days, currencies = self.days[selected], self.currencies[selected]
+            converted = self.amounts[selected]  # fancy indexing copies, so the lock can go
+            keys = self.categories[selected].astype(np.int64)
+            months = self.months[selected].astype(np.int64)
+            category_ids, currency_codes = list(self.category_ids), list(self.currency_codes)
+        rates = fx.get_rates()
+        for code, currency in enumerate(currency_codes):
+            matching = currencies == code
+            if currency == target or not matching.any():
+                continue
+            unique_days, inverse = np.unique(days[matching], return_inverse=True)
+            factors = np.asarray(rates.factors(currency, target, [date.fromordinal(int(d)) for d in unique_days]))
+            converted[matching] *= factors[inverse]
+
+        width = len(category_ids)
+        if by_month:
+            keys += months * width
+        length = width * (13 if by_month else 1)
+        sums = np.bincount(keys, weights=converted, minlength=length)
+        counts = np.bincount(keys, minlength=length)
+        return {
+            ((int(key) // width, category_ids[key % width]) if by_month else category_ids[key]):
+                float(sums[key])
+            for key in np.flatnonzero(counts)
+        }
+
+
+_stores = cache.UserStates(maxbytes=MAX_BYTES, sizeof=lambda store: store.nbytes)
+_reads = OrderedDict()  # user_id -> reads counted toward admission, least recently read first
+_reads_lock = threading.Lock()
+
+
+def _admit(user_id):
+    """Count a read without a store; True once the user has read often enough to get one.
+
+    Admitted users stay counted, so a store dropped as stale is reloaded on the next read.
+    """
+    with _reads_lock:
+        count = min(_reads.pop(user_id, 0) + 1, ADMIT_AFTER_READS)
+        _reads[user_id] = count
+        while len(_reads) > MAX_COUNTED_USERS:
+            _reads.popitem(last=False)
+        return count >= ADMIT_AFTER_READS
+
+
+def _load(db: Session, user_id: int, version: int):
+    rows = db.query(
+        models.Expense.id, models.Expense.date, models.Expense.amount,
+        models.Expense.currency, models.Expense.category_id, models.Expense.description
+    ).filter(models.Expense.user_id == user_id, models.Expense.deleted_at.is_(None)).all()
+    return ExpenseColumns(version, rows)
+
+
+def get_store(db: Session, user_id: int):
+    """The user's current columns, loading them once the user is admitted; None to read the database"""
+    if _stores.maxbytes <= 0:
+        return None
+    version = cache.versions.get(user_id)
+    store = _stores.get(user_id, version)
+    if store is None:
+        if not _admit(user_id):
+            return None
+        store = _load(db, user_id, version)
+        _stores.put(user_id, store)
+    return store
+
+
+def _patch(store, before, after):
+    if after is not None:
+        store.put(after)
+    elif before is not None:
+        store.remove(before.id)
+
+
+def expense_written(user_id: int, version: int, before=None, after=None):
+    _stores.patch(user_id, version, lambda store: _patch(store, before, after))
+
+
+def clear():
+    _stores.clear()
+    with _reads_lock:
+        _reads.clear()
@@ -1,83 +1,361 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import desc, func
+from sqlalchemy.exc import IntegrityError
 import models, schemas
-from passlib.hash import bcrypt
-from datetime import datetime
+import os
+import threading
+from datetime import date, datetime
+from collections import OrderedDict, namedtuple
+from cache import RecentKeys, UserCache, user_changed
+import database
+import alerts, analytics, changes, colstore, events, fx, search
+
+# Derived per-user data (summaries, budget overviews); invalidated on every write
+summary_cache = UserCache()
 
 # ---------------------- USER ----------------------
 def create_user(db: Session, user: schemas.UserCreate):
+    """Create a user on the primary (`db`) and seed their data on the shard they are assigned"""
+    from passlib.hash import bcrypt  # imported on first use to keep app startup fast
     hashed_pw = bcrypt.hash(user.password)
     db_user = models.User(name=user.name, email=user.email, password_hash=hashed_pw)
     db.add(db_user)
-    db.commit()
+    db.flush()
+    db_user.shard = database.assign_shard(db_user.id)
+    if db_user.shard == 0:
+        db.add_all(models.Category(user_id=db_user.id, name=name) for name in DEFAULT_CATEGORIES)
+        db.commit()
+    else:
+        db.commit()
+        shard_db = database.open_session(db_user.shard)
+        try:
+            # Copy of the users row for foreign keys; logins only ever read the primary
+            shard_db.add(models.User(id=db_user.id, name=user.name, email=user.email, password_hash="!", shard=db_user.shard))
+            shard_db.add_all(models.Category(user_id=db_user.id, name=name) for name in DEFAULT_CATEGORIES)
+            shard_db.commit()
+        except Exception:
+            # Without its shard copy the account is unusable; let the email be registered again
+            db.delete(db_user)
+            db.commit()
+            raise
+        finally:
+            shard_db.close()
     db.refresh(db_user)
     return db_user
 
 def authenticate_user(db: Session, email: str, password: str):
+    from passlib.hash import bcrypt
     user = db.query(models.User).filter(models.User.email == email).first()
     if user and bcrypt.verify(password, user.password_hash):
         return user
     return None
 
+# ---------------------- CATEGORY ----------------------
+# Every new user starts with these; users can add their own
+DEFAULT_CATEGORIES = ['Food', 'Transport', 'Entertainment', 'Utilities', 'Shopping']
+
+MAX_CACHED_CATEGORY_MAPS = 10_000
+
+# user_id -> ({name: id}, {id: name}). Categories are only ever added, never
+# renamed or removed, so a map can only be missing entries: a lookup miss
+# reloads it once, which also picks up categories added by other workers.
+# Moving a user to another shard renumbers their categories, so each map
+# remembers the shard it was read from.
+_category_maps = OrderedDict()  # user_id -> (shard, maps)
+_category_lock = threading.Lock()
+
+def _load_category_map(db: Session, user_id: int):
+    by_name = dict(
+        db.query(models.Category.name, models.Category.id)
+        .filter(models.Category.user_id == user_id)
+        .all()
+    )
+    maps = (by_name, {category_id: name for name, category_id in by_name.items()})
+    with _category_lock:
+        _category_maps[user_id] = (database.shard_for(user_id), maps)
+        _category_maps.move_to_end(user_id)
+        while len(_category_maps) > MAX_CACHED_CATEGORY_MAPS:
+            _category_maps.popitem(last=False)
+    return maps
+
+def _category_map(db: Session, user_id: int):
+    shard = database.shard_for(user_id)
+    with _category_lock:
+        entry = _category_maps.get(user_id)
+        if entry is not None and entry[0] == shard:
+            _category_maps.move_to_end(user_id)
+            return entry[1]
+    return _load_category_map(db, user_id)
+
+def get_categories(db: Session, user_id: int):
+    """The user's category names, in creation order"""
+    return [name for _, name in sorted(_category_map(db, user_id)[1].items())]
+
+def get_category_id(db: Session, user_id: int, name: str):
+    """Resolve a category name to its id, raising ValueError for unknown names"""
+    category_id = _category_map(db, user_id)[0].get(name)
+    if category_id is None:
+        category_id = _load_category_map(db, user_id)[0].get(name)
+    if category_id is None:
+        raise ValueError(f"Invalid category. Allowed categories: {get_categories(db, user_id)}")
+    return category_id
+
+def get_category_names(db: Session, user_id: int, category_ids=()):
+    """{id: name} for the user, reloaded if any of `category_ids` is unknown"""
+    by_id = _category_map(db, user_id)[1]
+    if any(category_id not in by_id for category_id in category_ids):
+        by_id = _load_category_map(db, user_id)[1]
+    return by_id
+
+def create_category(db: Session, user_id: int, name: str):
+    name = name.strip()
+    if not name or len(name) > 50:
+        raise ValueError("Category name must be 1-50 characters")
+    category = models.Category(user_id=user_id, name=name)
+    db.add(category)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise ValueError(f"Category {name!r} already exists")
+    db.refresh(category)
+    _load_category_map(db, user_id)
+    return category
+
+def _named_totals(db: Session, user_id: int, totals_by_id: dict):
+    """Turn {category_id: total} into {name: total} for every category of the user"""
+    names = get_category_names(db, user_id, totals_by_id)
+    named = {name: 0 for name in get_categories(db, user_id)}
+    for category_id, total in totals_by_id.items():
+        named[names[category_id]] += total
+    return named
+
 # ---------------------- EXPENSE ----------------------
-ALLOWED_CATEGORIES = ['Food', 'Transport', 'Entertainment', 'Utilities', 'Shopping']
+# Deleted expenses are kept with deleted_at set; every live query filters on this
+LIVE = models.Expense.deleted_at.is_(None)
+
+MAX_EXPENSE_BATCH = 500
+MAX_IDEMPOTENCY_KEY_LENGTH = 64
+
+# (user_id, idempotency key) pairs that already created rows, so a retry
+# skips straight to looking them up. Only a shortcut: the unique index on
+# (user_id, idempotency_key) is what catches retries that land on another
+# worker or after the entry expired.
+_recent_keys = RecentKeys(ttl=int(os.getenv("IDEMPOTENCY_TTL", "3600")))
+
+# Detached copy of an expense row as it was before / after a write
+ExpenseSnapshot = namedtuple("ExpenseSnapshot", "id date amount currency category_id description")
+
+def _snapshot(expense: models.Expense):
+    return ExpenseSnapshot(
+        expense.id, expense.date, expense.amount, expense.currency, expense.category_id, expense.description
+    )
+
+def validate_currency(currency: str):
+    currencies = fx.get_rates().currencies()
+    if currency not in currencies:
+        raise ValueError(f"Invalid currency. Allowed currencies: {currencies}")
+    return currency
+
+def _expense_written(db: Session, user_id: int, before=None, after=None):
+    """Post-commit hook for every expense write: invalidate caches, patch derived state"""
+    version = user_changed(user_id)
+    alerts.expense_written(db, user_id, version, before, after)
+    search.expense_written(user_id, version, before, after)
+    analytics.expense_written(user_id, version, before, after)
+    colstore.expense_written(user_id, version, before, after)
+    if events.has_subscribers(user_id):
+        category_ids = {row.category_id for row in (before, after) if row is not None}
+        events.expense_written(user_id, version, before, after, get_category_names(db, user_id, category_ids))
+
+def expenses_bulk_written(db: Session, user_id: int, months):
+    """Post-commit hook for batch inserts touching the given (year, month)s"""
+    version = user_changed(user_id)
+    for year, month in months:
+        alerts.month_changed(db, user_id, version, year, month)
+    events.bulk_written(user_id, version)
+
+def create_expense(db: Session, user_id: int, expense: schemas.ExpenseCreate, idempotency_key: str = None):
+    """The new expense; None for a retry whose expense was deleted since"""
+    rows = create_expenses(db, user_id, [expense], idempotency_key)
+    return rows[0] if rows else None
+
+def _expenses_by_id(db: Session, user_id: int, ids):
+    return db.query(models.Expense)\
+        .filter(models.Expense.user_id == user_id, models.Expense.id.in_(ids))\
+        .order_by(models.Expense.id)\
+        .all()
+
+def _expenses_by_key(db: Session, user_id: int, row_keys):
+    """Rows an earlier request stored under `row_keys`, soft-deleted ones included"""
+    return db.query(models.Expense)\
+        .filter(models.Expense.user_id == user_id, models.Expense.idempotency_key.in_(row_keys))\
+        .order_by(models.Expense.id)\
+        .all()
+
+def create_expenses(db: Session, user_id: int, expenses, idempotency_key: str = None):
+    """Insert expenses in one transaction; returns the rows in order.
+
+    A retry with the same idempotency key returns the rows of the first
+    request that are still live, without inserting, logging or
+    invalidating anything. Row i stores "<key>:<i>", so the unique index
+    rejects the retry's insert even when the in-memory shortcut does not
+    know the key; either way the rows are found by (user, row key), which
+    survives a shard move.
+    """
+    if not 0 < len(expenses) <= MAX_EXPENSE_BATCH:
+        raise ValueError(f"Add 1 to {MAX_EXPENSE_BATCH} expenses at a time")
+    if idempotency_key is not None:
+        if not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise ValueError(f"Idempotency key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+        row_keys = [f"{idempotency_key}:{i}" for i in range(len(expenses))]
+        if _recent_keys.get((user_id, idempotency_key)):
+            rows = _expenses_by_key(db, user_id, row_keys)
+            if rows:
+                return [row for row in rows if row.deleted_at is None]
+    else:
+        row_keys = [None] * len(expenses)
 
-def create_expense(db: Session, user_id: int, expense: schemas.ExpenseCreate):
-    if expense.category not in ALLOWED_CATEGORIES:
-        raise ValueError(f"Invalid category. Allowed categories: {ALLOWED_CATEGORIES}")
-    db_exp = models.Expense(**expense.dict(), user_id=user_id)
-    db.add(db_exp)
+    rows = []
+    for expense, row_key in zip(expenses, row_keys):
+        fields = expense.dict()
+        fields["category_id"] = get_category_id(db, user_id, fields.pop("category"))
+        validate_currency(fields["currency"])
+        rows.append(models.Expense(**fields, user_id=user_id, idempotency_key=row_key))
+    db.add_all(rows)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        if idempotency_key is None:
+            raise
+        # Committed by an earlier attempt (or one still in flight, which the index waited for)
+        rows = _expenses_by_key(db, user_id, row_keys)
+        if not rows:
+            raise
+        _recent_keys.put((user_id, idempotency_key), True)
+        return [row for row in rows if row.deleted_at is None]
+    changes.log_changes(
+        db, user_id, [("expense", row.id, "upsert", changes.expense_data(row)) for row in rows]
+    )
+    ids = [row.id for row in rows]
     db.commit()
-    db.refresh(db_exp)
-    return db_exp
+    if idempotency_key is not None:
+        _recent_keys.put((user_id, idempotency_key), True)
+
+    if len(rows) == 1:
+        db.refresh(rows[0])
+        _expense_written(db, user_id, after=_snapshot(rows[0]))
+        return rows
+    rows = _expenses_by_id(db, user_id, ids)
+    expenses_bulk_written(db, user_id, {(row.date.year, row.date.month) for row in rows})
+    return rows
+
+def get_expense(db: Session, user_id: int, expense_id: int):
+    return db.query(models.Expense)\
+        .filter(models.Expense.id == expense_id, models.Expense.user_id == user_id, LIVE)\
+        .first()
+
+def _snapshot_query(db: Session, user_id: int):
+    return db.query(
+        models.Expense.id, models.Expense.date, models.Expense.amount,
+        models.Expense.currency, models.Expense.category_id, models.Expense.description
+    ).filter(models.Expense.user_id == user_id, LIVE)
 
 def get_expenses(db: Session, user_id: int):
+    """Live expenses as ExpenseSnapshots, newest first; from the column store when the user has one"""
+    store = colstore.get_store(db, user_id)
+    if store is not None:
+        return [ExpenseSnapshot._make(row) for row in store.rows()]
+    return [
+        ExpenseSnapshot._make(row) for row in _snapshot_query(db, user_id)
+        .order_by(desc(models.Expense.date), desc(models.Expense.id))
+    ]
+
+def get_recent_expenses(db: Session, user_id: int, limit: int = 10):
     return db.query(models.Expense)\
-        .filter(models.Expense.user_id == user_id)\
-        .order_by(desc(models.Expense.date))\
+        .filter(models.Expense.user_id == user_id, LIVE)\
+        .order_by(desc(models.Expense.date), desc(models.Expense.id))\
+        .limit(limit)\
         .all()
 
 def get_expenses_by_month(db: Session, user_id: int, month: str):
-    """Get expenses for a specific month (by name)"""
+    """Live expenses of a month (by name) as ExpenseSnapshots, newest first"""
     month_number = datetime.strptime(month, "%B").month
-    return db.query(models.Expense)\
-        .filter(
-            models.Expense.user_id == user_id,
-            func.extract('month', models.Expense.date) == month_number
-        )\
-        .order_by(desc(models.Expense.date))\
-        .all()
+    store = colstore.get_store(db, user_id)
+    if store is not None:
+        return [ExpenseSnapshot._make(row) for row in store.rows(month_number)]
+    return [
+        ExpenseSnapshot._make(row) for row in _snapshot_query(db, user_id)
+        .filter(func.extract('month', models.Expense.date) == month_number)
+        .order_by(desc(models.Expense.date), desc(models.Expense.id))
+    ]
+
+def get_archived_expenses(db: Session, user_id: int, month: str = None):
+    """Archived (not deleted) expenses, newest first, optionally for one month (by name)"""
+    query = db.query(models.ExpenseArchive).filter(
+        models.ExpenseArchive.user_id == user_id,
+        models.ExpenseArchive.deleted_at.is_(None)
+    )
+    if month:
+        query = query.filter(func.extract('month', models.ExpenseArchive.date) == _month_number(month))
+    return query.order_by(desc(models.ExpenseArchive.date)).all()
 
-def delete_expense(db: Session, expense_id: int):
-    expense = db.query(models.Expense).filter(models.Expense.id == expense_id).first()
+def _expense_query(db: Session, expense_id: int, user_id: int = None):
+    query = db.query(models.Expense).filter(models.Expense.id == expense_id, LIVE)
+    if user_id is not None:
+        query = query.filter(models.Expense.user_id == user_id)
+    return query
+
+def delete_expense(db: Session, expense_id: int, user_id: int = None):
+    expense = _expense_query(db, expense_id, user_id).first()
     if expense:
-        db.delete(expense)
+        owner_id, before = expense.user_id, _snapshot(expense)
+        changes.log_changes(db, owner_id, [("expense", expense.id, "delete", None)])
+        expense.deleted_at = datetime.utcnow()
         db.commit()
+        _expense_written(db, owner_id, before=before)
+        return True
+    return False
 
-def update_expense(db: Session, expense_id: int, updated: schemas.ExpenseCreate):
-    if updated.category not in ALLOWED_CATEGORIES:
-        raise ValueError(f"Invalid category. Allowed categories: {ALLOWED_CATEGORIES}")
-    expense = db.query(models.Expense).filter(models.Expense.id == expense_id).first()
+def update_expense(db: Session, expense_id: int, updated: schemas.ExpenseCreate, user_id: int = None):
+    expense = _expense_query(db, expense_id, user_id).first()
     if expense:
-        for key, value in updated.dict().items():
+        fields = updated.dict()
+        fields["category_id"] = get_category_id(db, expense.user_id, fields.pop("category"))
+        validate_currency(fields["currency"])
+        before = _snapshot(expense)
+        for key, value in fields.items():
             setattr(expense, key, value)
+        changes.log_changes(db, expense.user_id, [("expense", expense.id, "upsert", changes.expense_data(expense))])
         db.commit()
         db.refresh(expense)
+        _expense_written(db, expense.user_id, before=before, after=_snapshot(expense))
         return expense
     return None
 
 # ---------------------- BUDGET ----------------------
-def create_budget(db: Session, user_id: int, month: str, amount: float):
+def _budget_written(db: Session, user_id: int, budget: models.Budget):
+    """Post-commit hook for budget writes"""
+    version = user_changed(user_id)
+    alerts.budget_written(db, user_id, version, budget)
+    events.budget_written(user_id, version, budget)
+
+def create_budget(db: Session, user_id: int, month: str, amount: float, currency: str = fx.BASE_CURRENCY):
     """Create a budget for a specific month (without year tracking)"""
     budget = models.Budget(
         user_id=user_id,
         month=month,
         year=datetime.now().year,  # Store current year but don't use it for filtering
-        amount=amount
+        amount=amount,
+        currency=validate_currency(currency)
     )
     db.add(budget)
+    db.flush()
+    changes.log_changes(db, user_id, [("budget", budget.id, "upsert", changes.budget_data(budget))])
     db.commit()
     db.refresh(budget)
+    _budget_written(db, user_id, budget)
     return budget
 
 def get_budget(db: Session, user_id: int, month: str):
@@ -110,24 +388,43 @@ def get_all_budgets(db: Session, user_id: int):
         .filter(models.Budget.user_id == user_id)\
         .all()
 
-def update_budget(db: Session, user_id: int, month: str, amount: float):
+def update_budget(db: Session, user_id: int, month: str, amount: float, currency: str = fx.BASE_CURRENCY):
     """Update or create budget for a month"""
     budget = get_budget(db, user_id, month)
     if budget:
         budget.amount = amount
+        budget.currency = validate_currency(currency)
+        changes.log_changes(db, user_id, [("budget", budget.id, "upsert", changes.budget_data(budget))])
+        db.commit()
+        _budget_written(db, user_id, budget)
     else:
-        budget = create_budget(db, user_id, month, amount)
-    db.commit()
+        budget = create_budget(db, user_id, month, amount, currency)
     return budget
 
 # ---------------------- SUMMARY ----------------------
-def get_monthly_summary(db: Session, user_id: int, month: str = None):
-    """Get comprehensive monthly summary data"""
+# Every summary is reported in one target currency. Expenses are grouped by
+# (currency, date) in SQL and each currency is converted in one batch; the
+# results are cached per (user, month, target currency).
+
+def _budget_amount(budget: models.Budget, currency: str):
+    """Budget amount in `currency`, at the rate of the first day of its month"""
+    first_day = date(budget.year, _month_number(budget.month), 1)
+    return budget.amount * fx.get_rates().factors(budget.currency, currency, [first_day])[0]
+
+def get_monthly_summary(db: Session, user_id: int, month: str = None, currency: str = fx.BASE_CURRENCY):
+    """Get comprehensive monthly summary data (cached until the user's next write)"""
+    return summary_cache.get_or_compute(
+        user_id, ("monthly_summary", month, currency),
+        lambda: _compute_monthly_summary(db, user_id, month, currency)
+    )
+
+def _compute_monthly_summary(db: Session, user_id: int, month: str = None, currency: str = fx.BASE_CURRENCY):
     result = {
         'total_budget': 0,
         'total_expenses': 0,
-        'category_expenses': {c: 0 for c in ALLOWED_CATEGORIES},
-        'difference': 0
+        'category_expenses': {},
+        'difference': 0,
+        'currency': currency
     }
 
     # Get budgets (all or filtered by month)
@@ -140,27 +437,118 @@ def get_monthly_summary(db: Session, user_id: int, month: str = None):
         budgets = get_all_budgets(db, user_id)
 
     # Calculate totals
-    result['total_budget'] = sum(b.amount for b in budgets)
+    result['total_budget'] = sum(_budget_amount(b, currency) for b in budgets)
 
-    # Get expenses (all or filtered by month)
-    expenses = []
-    if month:
-        expenses = get_expenses_by_month(db, user_id, month)
-    else:
-        expenses = get_expenses(db, user_id)
+    # Get expense totals per category (all or filtered by month)
+    totals_by_id = _category_totals_by_id(db, user_id, month, currency)
 
     # Calculate expense totals
-    result['total_expenses'] = sum(e.amount for e in expenses)
+    result['total_expenses'] = sum(totals_by_id.values())
     result['difference'] = result['total_budget'] - result['total_expenses']
 
     # Calculate category breakdown
-    for expense in expenses:
-        result['category_expenses'][expense.category] += expense.amount
+    result['category_expenses'] = _named_totals(db, user_id, totals_by_id)
 
     return result
 
+def _month_number(month: str):
+    return datetime.strptime(month, "%B").month
+
+def _category_totals_by_id(db: Session, user_id: int, month: str = None, currency: str = fx.BASE_CURRENCY):
+    """{category_id: total in currency} of live expenses, from the column store when it is on"""
+    store = colstore.get_store(db, user_id)
+    if store is not None:
+        return store.totals(currency, _month_number(month) if month else None)
+    # Grouped per category, currency and day so each day converts at its own rate
+    query = db.query(
+        models.Expense.category_id, models.Expense.currency, models.Expense.date, func.sum(models.Expense.amount)
+    ).filter(models.Expense.user_id == user_id, LIVE)
+    if month:
+        query = query.filter(func.extract('month', models.Expense.date) == _month_number(month))
+    rows = query.group_by(models.Expense.category_id, models.Expense.currency, models.Expense.date).all()
+    return fx.get_rates().convert_grouped(rows, currency)
+
+def _archived_rows(db: Session, user_id: int, month: str = None):
+    """(category_id, currency, first day of month, total) rows from the archive rollups"""
+    query = db.query(
+        models.ExpenseRollup.category_id, models.ExpenseRollup.currency,
+        models.ExpenseRollup.year, models.ExpenseRollup.month, models.ExpenseRollup.total
+    ).filter(models.ExpenseRollup.user_id == user_id)
+    if month:
+        query = query.filter(models.ExpenseRollup.month == _month_number(month))
+    return [(category_id, cur, date(year, m, 1), total) for category_id, cur, year, m, total in query]
+
+def get_category_totals(db: Session, user_id: int, month: str = None, currency: str = fx.BASE_CURRENCY,
+                        include_archive: bool = False):
+    """Expense totals per category, optionally for one month (by name) and including archived months"""
+    def compute():
+        totals_by_id = _category_totals_by_id(db, user_id, month, currency)
+        if include_archive:
+            for category_id, total in fx.get_rates().convert_grouped(_archived_rows(db, user_id, month), currency).items():
+                totals_by_id[category_id] = totals_by_id.get(category_id, 0) + total
+        names = get_category_names(db, user_id, totals_by_id)
+        return {names[category_id]: total for category_id, total in totals_by_id.items()}
+
+    return summary_cache.get_or_compute(user_id, ("category_totals", month, currency, include_archive), compute)
+
+def get_budget_overview(db: Session, user_id: int, month: str = None, currency: str = fx.BASE_CURRENCY):
+    """Budgets with their spent totals and category breakdown, as plain dicts"""
+    def compute():
+        query = db.query(models.Budget).filter(models.Budget.user_id == user_id)
+        if month:
+            query = query.filter(models.Budget.month == month)
+        budgets = query.order_by(models.Budget.month).all()
+        if not budgets:
+            return []
+
+        budget_months = {_month_number(b.month) for b in budgets}
+        store = colstore.get_store(db, user_id)
+        if store is not None:
+            converted = store.totals(currency, by_month=True)
+        else:
+            # One grouped query for every budgeted month instead of one scan per budget
+            month_col = func.extract('month', models.Expense.date)
+            rows = db.query(
+                month_col, models.Expense.category_id, models.Expense.currency,
+                models.Expense.date, func.sum(models.Expense.amount)
+            )\
+                .filter(
+                    models.Expense.user_id == user_id,
+                    LIVE,
+                    month_col.in_(budget_months)
+                )\
+                .group_by(month_col, models.Expense.category_id, models.Expense.currency, models.Expense.date)\
+                .all()
+            converted = fx.get_rates().convert_grouped(
+                (((int(m), category_id), cur, day, total) for m, category_id, cur, day, total in rows), currency
+            )
+        spent = {}
+        for (month_number, category_id), total in converted.items():
+            spent.setdefault(month_number, {})[category_id] = total
+
+        overview = []
+        for budget in budgets:
+            category_expenses = _named_totals(db, user_id, spent.get(_month_number(budget.month), {}))
+            total_expenses = sum(category_expenses.values())
+            amount = _budget_amount(budget, currency)
+            overview.append({
+                "budget": {
+                    "id": budget.id,
+                    "month": budget.month,
+                    "year": budget.year,
+                    "amount": amount,
+                    "currency": budget.currency
+                },
+                "total_expenses": total_expenses,
+                "difference": amount - total_expenses,
+                "category_expenses": category_expenses
+            })
+        return overview
+
+    return summary_cache.get_or_compute(user_id, ("budget_overview", month, currency), compute)
+
 def get_total_expenses(db: Session, user_id: int):
-    total = db.query(func.sum(models.Expense.amount)).filter(models.Expense.user_id == user_id).scalar()
+    total = db.query(func.sum(models.Expense.amount)).filter(models.Expense.user_id == user_id, LIVE).scalar()
     return total or 0
 
 def get_total_budget(db: Session, user_id: int):
@@ -0,0 +1,167 @@
+"""Per-user server-sent events carrying budget and spend deltas.
+
+Writes publish from request threads (crud hooks) into per-connection
+asyncio queues via call_soon_threadsafe; an idle connection is one
+suspended coroutine and an empty queue. Writes made by other workers are
+detected by one poller per process comparing cache.versions for every
+connected user, and surface as a "resync" event.
+"""
+import asyncio
+import json
+import threading
+from datetime import date, datetime
+
+import cache
+import fx
+
+# Seconds between keepalive comments on an idle stream
+KEEPALIVE_INTERVAL = 15
+
+# Seconds between cross-worker version checks
+POLL_INTERVAL = 2
+
+# Undelivered events per connection before it is told to resync instead
+QUEUE_SIZE = 256
+
+_subscribers = {}  # user_id -> set of (loop, queue)
+_known_versions = {}  # user_id -> latest version this process has published for
+_lock = threading.Lock()
+_poller = None
+
+
+# ---------------------- BROKER ----------------------
+def _put(queue: asyncio.Queue, event):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        # A slow client only needs to know it fell behind
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({"type": "resync"})
+
+
+def publish(user_id: int, version: int, event: dict):
+    """Deliver `event` to every connection of the user; safe to call from any thread"""
+    with _lock:
+        targets = list(_subscribers.get(user_id, ()))
+        if targets:
+            _known_versions[user_id] = max(version, _known_versions.get(user_id, 0))
+    for loop, queue in targets:
+        try:
+            loop.call_soon_threadsafe(_put, queue, event)
+        except RuntimeError:
+            pass  # the connection's event loop is already closed
+
+
+def has_subscribers(user_id: int):
+    return user_id in _subscribers
+
+
+def subscribe(user_id: int):
+    global _poller
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    with _lock:
+        _subscribers.setdefault(user_id, set()).add((loop, queue))
+        _known_versions.setdefault(user_id, cache.versions.get(user_id))
+        if _poller is None or _poller.done() or _poller.get_loop() is not loop:
+            _poller = loop.create_task(_poll_versions())
+    return queue
+
+
+def unsubscribe(user_id: int, queue: asyncio.Queue):
+    with _lock:
+        queues = _subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.difference_update({entry for entry in queues if entry[1] is queue})
+        if not queues:
+            del _subscribers[user_id]
+            _known_versions.pop(user_id, None)
+
+
+async def _poll_versions():
+    """Tell connected users to resync when another worker changed their data.
+
+    A version must stay ahead for two checks in a row, so a local write
+    whose event is still in flight does not trigger a needless resync.
+    """
+    behind = set()
+    while _subscribers:
+        await asyncio.sleep(POLL_INTERVAL)
+        user_ids = list(_subscribers)
+        current = await asyncio.to_thread(cache.versions.get_many, user_ids)
+        still_behind = set()
+        for user_id, version in current.items():
+            if version > _known_versions.get(user_id, version):
+                if user_id in behind:
+                    publish(user_id, version, {"type": "resync"})
+                else:
+                    still_behind.add(user_id)
+        behind = still_behind
+
+
+# ---------------------- WRITE HOOKS ----------------------
+def expense_written(user_id: int, version: int, before, after, category_names: dict):
+    """Publish the signed per-month, per-category change of one expense write"""
+    rows = [(row, sign) for row, sign in ((before, -1), (after, 1)) if row is not None]
+    publish(user_id, version, {
+        "type": "expense",
+        "deltas": [
+            (row.date.strftime("%B"), category_names[row.category_id], row.currency, row.date, sign * row.amount)
+            for row, sign in rows
+        ],
+    })
+
+
+def budget_written(user_id: int, version: int, budget):
+    if not has_subscribers(user_id):
+        return
+    first_day = date(budget.year, datetime.strptime(budget.month, "%B").month, 1)
+    publish(user_id, version, {
+        "type": "budget", "month": budget.month, "amount": budget.amount,
+        "currency": budget.currency, "date": first_day,
+    })
+
+
+def bulk_written(user_id: int, version: int):
+    """Batch writes (recurring expenses, archival) are not itemized; clients reload"""
+    if has_subscribers(user_id):
+        publish(user_id, version, {"type": "resync"})
+
+
+# ---------------------- STREAM ----------------------
+def _format(event: dict, currency: str):
+    """An SSE message with amounts converted into the stream's display currency"""
+    rates = fx.get_rates()
+    if event["type"] == "expense":
+        data = {"deltas": [
+            {
+                "month": month, "category": category,
+                "amount": amount * rates.factors(cur, currency, [day])[0],
+            }
+            for month, category, cur, day, amount in event["deltas"]
+        ]}
+    elif event["type"] == "budget":
+        data = {
+            "month": event["month"],
+            "amount": event["amount"] * rates.factors(event["currency"], currency, [event["date"]])[0],
+        }
+    else:
+        data = {}
+    return f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream(user_id: int, currency: str):
+    queue = subscribe(user_id)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _format(event, currency)
+    finally:
+        unsubscribe(user_id, queue)
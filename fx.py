@@ -0,0 +1,107 @@
+"""Foreign exchange rates loaded from a local CSV file.
+
+The file (FX_RATES_PATH, default fx_rates.csv) has one rate per line:
+
+    date,currency,rate
+    2025-01-01,USD,85.6
+
+where `rate` is the value of one unit of `currency` in BASE_CURRENCY,
+effective from `date` until the next line for that currency. Without a
+file only BASE_CURRENCY is available.
+"""
+import csv
+import os
+import threading
+from bisect import bisect_right
+from datetime import date
+
+BASE_CURRENCY = "INR"
+
+FX_RATES_PATH = os.getenv("FX_RATES_PATH", "fx_rates.csv")
+
+CURRENCY_SYMBOLS = {"INR": "₹", "USD": "$", "EUR": "€", "GBP": "£", "JPY": "¥"}
+
+
+class RateTable:
+    """Per currency: sorted date ordinals and the rates effective from them"""
+
+    def __init__(self, rows=()):
+        series = {}
+        for day, currency, rate in rows:
+            series.setdefault(currency, []).append((day.toordinal(), rate))
+        self._days, self._rates = {}, {}
+        for currency, points in series.items():
+            points.sort()
+            self._days[currency] = [d for d, _ in points]
+            self._rates[currency] = [r for _, r in points]
+
+    @classmethod
+    def from_csv(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with open(path, newline="") as f:
+            return cls(
+                (date.fromisoformat(row["date"]), row["currency"].strip().upper(), float(row["rate"]))
+                for row in csv.DictReader(f)
+            )
+
+    def currencies(self):
+        return sorted({BASE_CURRENCY, *self._days})
+
+    def rates(self, currency: str, days):
+        """Rates in BASE_CURRENCY for `currency` on each of `days` (one bisect per day)"""
+        if currency == BASE_CURRENCY:
+            return [1.0] * len(days)
+        if currency not in self._days:
+            raise ValueError(f"No FX rates for {currency}")
+        known_days, known_rates = self._days[currency], self._rates[currency]
+        # Before the first known date, fall back to the earliest rate
+        return [known_rates[max(bisect_right(known_days, d.toordinal()) - 1, 0)] for d in days]
+
+    def rate(self, currency: str, day: date):
+        return self.rates(currency, [day])[0]
+
+    def factors(self, currency: str, target: str, days):
+        """Multipliers turning `currency` amounts on `days` into `target`"""
+        if currency == target:
+            return [1.0] * len(days)
+        return [s / t for s, t in zip(self.rates(currency, days), self.rates(target, days))]
+
+    def convert_grouped(self, rows, target: str):
+        """Sum (key, currency, day, amount) rows into {key: total in target}.
+
+        Rows are bucketed by currency first so each currency's rates are
+        looked up in one batch instead of once per row.
+        """
+        by_currency = {}
+        for row in rows:
+            by_currency.setdefault(row[1], []).append(row)
+        totals = {}
+        for currency, items in by_currency.items():
+            factors = self.factors(currency, target, [day for _, _, day, _ in items])
+            for (key, _, _, amount), factor in zip(items, factors):
+                totals[key] = totals.get(key, 0) + amount * factor
+        return totals
+
+
+_table = None
+_lock = threading.Lock()
+
+
+def get_rates():
+    """The process-wide rate table, loaded from FX_RATES_PATH on first use"""
+    global _table
+    if _table is None:
+        with _lock:
+            if _table is None:
+                _table = RateTable.from_csv(FX_RATES_PATH)
+    return _table
+
+
+def money_prefix(currency: str = BASE_CURRENCY):
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    return symbol if symbol else f"{currency} "
+
+
+def format_money(amount, currency: str = BASE_CURRENCY):
+    return f"{money_prefix(currency)}{amount:.2f}"
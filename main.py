@@ -1,58 +1,103 @@
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi import FastAPI, Request, Form, Depends, Header, HTTPException
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse
+# Stays eager: it only adds starlette.staticfiles (~0.5ms), its dependencies load with fastapi
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from starlette.middleware.sessions import SessionMiddleware
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from sessions import ServerSessionMiddleware, create_session_store
+from ratelimit import RateLimitMiddleware, check_account, create_buckets
 from sqlalchemy.orm import Session
-from datetime import datetime, date
-import crud, models, schemas
-from database import engine, SessionLocal
-from auth import get_db, login_user, get_current_user
-from models import User, Budget, Expense
-from typing import Optional
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime, date, timedelta
+import analytics, archive, cache, changes, crud, database, events, fx, models, recurring, scheduler, schemas, search, widgets
+from database import get_engine, dispose_engine
+from auth import get_db, get_primary_db, get_session_factory, login_user, get_current_user
+from models import Budget
+from typing import List, Optional
+import os
+import uuid
 
-from sqlalchemy import func
+# Schema changes are applied with `python migrate.py`, never at import or startup
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_engine()
+    jobs = scheduler.start()
+    yield
+    await scheduler.stop(jobs)
+    dispose_engine()
 
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
-app.add_middleware(SessionMiddleware, secret_key="your-secret-key")
+app = FastAPI(lifespan=lifespan)
+# Sessions live server-side; set SESSION_BACKEND=sqlite when running several workers
+session_store = create_session_store(
+    backend=os.getenv("SESSION_BACKEND", "memory"),
+    path=os.getenv("SESSION_DB_PATH", "sessions.db"),
+)
+app.add_middleware(ServerSessionMiddleware, store=session_store)
+# Added last so it runs first: throttled requests skip the session lookup too
+rate_buckets = create_buckets(
+    backend=os.getenv("RATE_LIMIT_BACKEND", "memory"),
+    path=os.getenv("RATE_LIMIT_DB_PATH", "ratelimit.db"),
+)
+app.add_middleware(RateLimitMiddleware, buckets=rate_buckets)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-templates = Jinja2Templates(directory="templates")
+@lru_cache(maxsize=None)
+def get_templates():
+    # Jinja2 is only imported when the first page is rendered
+    from fastapi.templating import Jinja2Templates
+    templates = Jinja2Templates(directory="templates")
+    templates.env.filters["money"] = fx.format_money
+    return templates
+
+def render(name: str, context: dict):
+    return get_templates().TemplateResponse(name, context)
 
 @app.get("/", response_class=HTMLResponse)
 def home(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return render("login.html", {"request": request})
 
 @app.post("/login")
-def login(request: Request, db: Session = Depends(get_db), email: str = Form(...), password: str = Form(...)):
+def login(request: Request, db: Session = Depends(get_primary_db), email: str = Form(...), password: str = Form(...)):
+    throttled = check_account(rate_buckets, email)
+    if throttled:
+        return throttled
     user = login_user(request, db, email, password)
     if not user:
-        return templates.TemplateResponse("login.html", {"request": request, "msg": "Invalid credentials"})
+        return render("login.html", {"request": request, "msg": "Invalid credentials"})
     return RedirectResponse(url="/dashboard", status_code=302)
 
 @app.get("/register", response_class=HTMLResponse)
 def register_form(request: Request):
-    return templates.TemplateResponse("register.html", {"request": request})
+    return render("register.html", {"request": request})
 
 @app.post("/register")
-def register_user(request: Request, name: str = Form(...), email: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+def register_user(request: Request, name: str = Form(...), email: str = Form(...), password: str = Form(...), db: Session = Depends(get_primary_db)):
+    throttled = check_account(rate_buckets, email)
+    if throttled:
+        return throttled
     existing = db.query(models.User).filter(models.User.email == email).first()
     if existing:
-        return templates.TemplateResponse("register.html", {"request": request, "msg": "Email already registered"})
+        return render("register.html", {"request": request, "msg": "Email already registered"})
     
     user_data = schemas.UserCreate(name=name, email=email, password=password)
     crud.create_user(db, user_data)
     return RedirectResponse("/", status_code=302)
 
 @app.get("/dashboard")
-def dashboard(request: Request, db: Session = Depends(get_db)):
-    user = get_current_user(request, db)
+async def dashboard(request: Request, db: Session = Depends(get_db), session_factory=Depends(get_session_factory)):
+    # Blocking query: keep it off the event loop
+    user = await run_in_threadpool(get_current_user, request, db)
     if not user:
         return RedirectResponse("/")
-    return templates.TemplateResponse("dashboard.html", {"request": request, "user": user})
+    # Widgets run concurrently, each with its own session; late ones render as unavailable
+    results, missing = await widgets.gather(session_factory, user.id, date.today())
+    return render("dashboard.html", {
+        "request": request,
+        "user": user,
+        "missing": missing,
+        **results
+    })
 
 @app.get("/logout")
 def logout(request: Request):
@@ -74,17 +119,19 @@ def add_budget_form(request: Request, db: Session = Depends(get_db)):
     existing_budgets = db.query(Budget).filter(Budget.user_id == user.id).all()
     budgeted_months = [budget.month for budget in existing_budgets]
     
-    return templates.TemplateResponse("add_budget.html", {
+    return render("add_budget.html", {
         "request": request,
         "months": months,
-        "budgeted_months": budgeted_months
+        "budgeted_months": budgeted_months,
+        "currencies": fx.get_rates().currencies()
     })
 
 @app.post("/add-budget")
-async def add_budget(
+def add_budget(
     request: Request,
     month: str = Form(...),
     amount: float = Form(...),
+    currency: str = Form(fx.BASE_CURRENCY),
     db: Session = Depends(get_db)
 ):
     user = get_current_user(request, db)
@@ -100,15 +147,10 @@ async def add_budget(
     if existing_budget:
         raise HTTPException(status_code=400, detail="Budget already exists for this month")
     
-    # Create new budget
-    budget = Budget(
-        user_id=user.id,
-        month=month,
-        year=datetime.now().year,
-        amount=amount
-    )
-    db.add(budget)
-    db.commit()
+    try:
+        crud.create_budget(db, user.id, month, amount, currency)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return RedirectResponse("/view-budgets", status_code=303)
 
@@ -116,58 +158,44 @@ async def add_budget(
 def view_budgets(
     request: Request,
     month_filter: Optional[str] = None,
+    currency: str = fx.BASE_CURRENCY,
     db: Session = Depends(get_db)
 ):
     user = get_current_user(request, db)
     if not user:
         return RedirectResponse("/")
 
-    # Initialize budget data list
-    budget_data = []
-    
-    # Get all budgets for the user
-    query = db.query(Budget).filter(Budget.user_id == user.id)
-    
-    if month_filter:
-        query = query.filter(Budget.month == month_filter)
-    
-    budgets = query.order_by(Budget.month).all()
-    
-    # Calculate expenses for each budget
-    for budget in budgets:
-        # Get expenses for this month
-        expenses = db.query(Expense).filter(
-            Expense.user_id == user.id,
-            func.extract('month', Expense.date) == datetime.strptime(budget.month, "%B").month
-        ).all()
-        
-        # Calculate totals
-        total_expenses = sum(exp.amount for exp in expenses)
-        difference = budget.amount - total_expenses
-        
-        # Calculate expenses by category
-        category_expenses = {category: 0 for category in crud.ALLOWED_CATEGORIES}
-        for exp in expenses:
-            category_expenses[exp.category] += exp.amount
-        
-        budget_data.append({
-            "budget": budget,
-            "total_expenses": total_expenses,
-            "difference": difference,
-            "category_expenses": category_expenses
-        })
+    try:
+        budget_data = crud.get_budget_overview(db, user.id, month_filter, crud.validate_currency(currency))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Projected month-end spend and unusual days, keyed by budget id
+    budget_months = {
+        data["budget"]["id"]: (data["budget"]["year"], datetime.strptime(data["budget"]["month"], "%B").month)
+        for data in budget_data
+    }
+    outlooks = analytics.get_outlooks(
+        db, user.id, cache.versions.get(user.id), budget_months.values(), date.today(), currency
+    )
+    outlooks = {budget_id: outlooks[key] for budget_id, key in budget_months.items()}
     
     months = [
         "January", "February", "March", "April", "May", "June",
         "July", "August", "September", "October", "November", "December"
     ]
     
-    return templates.TemplateResponse("view_budgets.html", {
+    return render("view_budgets.html", {
         "request": request,
         "budget_data": budget_data,
+        "outlooks": outlooks,
+        "window_days": analytics.WINDOW_DAYS,
+        "currency": currency,
+        "currencies": fx.get_rates().currencies(),
+        "money_prefix": fx.money_prefix(currency),
         "months": months,
         "selected_month": month_filter,
-        "categories": crud.ALLOWED_CATEGORIES
+        "categories": crud.get_categories(db, user.id)
     })
 
 @app.get("/add-expense", response_class=HTMLResponse)
@@ -181,40 +209,42 @@ def add_expense_form(request: Request, db: Session = Depends(get_db)):
         "July", "August", "September", "October", "November", "December"
     ]
     
-    return templates.TemplateResponse("add_expense.html", {
+    return render("add_expense.html", {
         "request": request,
+        # Sent back with the form, so a double submit adds the expense once
+        "idempotency_key": uuid.uuid4().hex,
         "months": months,
-        "categories": crud.ALLOWED_CATEGORIES
+        "currencies": fx.get_rates().currencies(),
+        "categories": crud.get_categories(db, user.id)
     })
 
 @app.post("/add-expense")
-async def add_expense(
+def add_expense(
     request: Request,
     month: str = Form(...),
     amount: float = Form(...),
     category: str = Form(...),
     date: str = Form(...),
     description: str = Form(None),
+    currency: str = Form(fx.BASE_CURRENCY),
+    idempotency_key: str = Form(None),
     db: Session = Depends(get_db)
 ):
     user = get_current_user(request, db)
     if not user:
         return RedirectResponse("/")
     
-    # Validate category
-    if category not in crud.ALLOWED_CATEGORIES:
-        raise HTTPException(status_code=400, detail="Invalid category")
-    
-    # Create expense
-    expense = Expense(
-        user_id=user.id,
+    expense = schemas.ExpenseCreate(
         amount=amount,
         category=category,
+        currency=currency,
         date=datetime.strptime(date, "%Y-%m-%d").date(),
         description=description
     )
-    db.add(expense)
-    db.commit()
+    try:
+        crud.create_expense(db, user.id, expense, idempotency_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return RedirectResponse("/view-expenses", status_code=303)
 
@@ -222,32 +252,169 @@ async def add_expense(
 def view_expenses(
     request: Request,
     month_filter: Optional[str] = None,
+    include_archive: bool = False,
     db: Session = Depends(get_db)
 ):
     user = get_current_user(request, db)
     if not user:
         return RedirectResponse("/")
     
-    query = db.query(Expense).filter(Expense.user_id == user.id)
-    
     if month_filter:
-        # Use the imported func directly
-        query = query.filter(func.extract('month', Expense.date) == datetime.strptime(month_filter, "%B").month)
+        expenses = crud.get_expenses_by_month(db, user.id, month_filter)
+    else:
+        expenses = crud.get_expenses(db, user.id)
     
-    expenses = query.order_by(Expense.date.desc()).all()
+    # Expenses past the archive horizon only on request
+    archived = crud.get_archived_expenses(db, user.id, month_filter) if include_archive else []
+    
+    # Recurring occurrences of the selected month (this year) not generated yet
+    upcoming = []
+    if month_filter:
+        today = date.today()
+        month_number = datetime.strptime(month_filter, "%B").month
+        start = date(today.year, month_number, 1)
+        end = date(today.year + 1, 1, 1) if month_number == 12 else date(today.year, month_number + 1, 1)
+        upcoming = recurring.virtual_occurrences(db, user.id, start, end - timedelta(days=1))
     
     months = [
         "January", "February", "March", "April", "May", "June",
         "July", "August", "September", "October", "November", "December"
     ]
     
-    return templates.TemplateResponse("view_expenses.html", {
+    return render("view_expenses.html", {
         "request": request,
         "expenses": expenses,
+        "upcoming": upcoming,
+        "archived": archived,
+        "include_archive": include_archive,
+        "category_names": crud.get_category_names(db, user.id, {e.category_id for e in expenses + upcoming + archived}),
         "months": months,
         "selected_month": month_filter
     })
 
+@app.get("/categories", response_class=HTMLResponse)
+def categories_page(request: Request, db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/")
+    
+    return render("categories.html", {
+        "request": request,
+        "categories": crud.get_categories(db, user.id)
+    })
+
+@app.post("/add-category")
+def add_category(request: Request, name: str = Form(...), db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/")
+    
+    try:
+        crud.create_category(db, user.id, name)
+    except ValueError as e:
+        return render("categories.html", {
+            "request": request,
+            "categories": crud.get_categories(db, user.id),
+            "msg": str(e)
+        })
+    
+    return RedirectResponse("/categories", status_code=303)
+
+@app.get("/recurring", response_class=HTMLResponse)
+def recurring_page(request: Request, db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/")
+    
+    rules = recurring.get_rules(db, user.id)
+    
+    return render("recurring.html", {
+        "request": request,
+        "rules": rules,
+        "category_names": crud.get_category_names(db, user.id, {r.category_id for r in rules}),
+        "frequencies": recurring.FREQUENCIES,
+        "currencies": fx.get_rates().currencies(),
+        "categories": crud.get_categories(db, user.id)
+    })
+
+@app.post("/add-recurring")
+def add_recurring(
+    request: Request,
+    amount: float = Form(...),
+    category: str = Form(...),
+    frequency: str = Form(...),
+    interval: int = Form(1),
+    start_date: date = Form(...),
+    end_date: Optional[date] = Form(None),
+    description: str = Form(None),
+    currency: str = Form(fx.BASE_CURRENCY),
+    db: Session = Depends(get_db)
+):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/")
+    
+    try:
+        recurring.create_rule(
+            db, user.id, amount, category, description,
+            frequency, interval, start_date, end_date, currency
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return RedirectResponse("/recurring", status_code=303)
+
+@app.get("/delete-recurring/{rule_id}")
+def delete_recurring(request: Request, rule_id: int, db: Session = Depends(get_db)):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/")
+    
+    recurring.delete_rule(db, user.id, rule_id)
+    
+    return RedirectResponse("/recurring", status_code=303)
+
+@app.get("/search", response_class=HTMLResponse)
+def search_expenses(
+    request: Request,
+    q: str = "",
+    category: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    page: int = 1,
+    db: Session = Depends(get_db)
+):
+    user = get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/")
+    
+    per_page = 50
+    page = max(page, 1)
+    category_id = None
+    if category:
+        try:
+            category_id = crud.get_category_id(db, user.id, category)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid category")
+    expenses, total = search.search_expenses(
+        db, user.id, cache.versions.get(user.id), q, category_id,
+        date_from, date_to, page=page, per_page=per_page
+    )
+    
+    return render("search.html", {
+        "request": request,
+        "expenses": expenses,
+        "category_names": crud.get_category_names(db, user.id, {e.category_id for e in expenses}),
+        "total": total,
+        "q": q,
+        "selected_category": category,
+        "date_from": date_from,
+        "date_to": date_to,
+        "page": page,
+        "pages": max((total + per_page - 1) // per_page, 1),
+        "categories": crud.get_categories(db, user.id)
+    })
+
 @app.get("/edit-expense/{expense_id}", response_class=HTMLResponse)
 def edit_expense_form(
     request: Request,
@@ -258,10 +425,7 @@ def edit_expense_form(
     if not user:
         return RedirectResponse("/")
     
-    expense = db.query(Expense).filter(
-        Expense.id == expense_id,
-        Expense.user_id == user.id
-    ).first()
+    expense = crud.get_expense(db, user.id, expense_id)
     
     if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
@@ -271,15 +435,17 @@ def edit_expense_form(
         "July", "August", "September", "October", "November", "December"
     ]
     
-    return templates.TemplateResponse("edit_expense.html", {
+    return render("edit_expense.html", {
         "request": request,
         "expense": expense,
+        "category_names": crud.get_category_names(db, user.id, {expense.category_id}),
+        "currencies": fx.get_rates().currencies(),
         "months": months,
-        "categories": crud.ALLOWED_CATEGORIES
+        "categories": crud.get_categories(db, user.id)
     })
 
 @app.post("/update-expense/{expense_id}")
-async def update_expense(
+def update_expense(
     request: Request,
     expense_id: int,
     month: str = Form(...),
@@ -287,32 +453,28 @@ async def update_expense(
     category: str = Form(...),
     date: str = Form(...),
     description: str = Form(None),
+    currency: str = Form(fx.BASE_CURRENCY),
     db: Session = Depends(get_db)
 ):
     user = get_current_user(request, db)
     if not user:
         return RedirectResponse("/")
     
-    expense = db.query(Expense).filter(
-        Expense.id == expense_id,
-        Expense.user_id == user.id
-    ).first()
+    updated = schemas.ExpenseCreate(
+        amount=amount,
+        category=category,
+        currency=currency,
+        date=datetime.strptime(date, "%Y-%m-%d").date(),
+        description=description
+    )
+    try:
+        expense = crud.update_expense(db, expense_id, updated, user_id=user.id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
     
-    # Validate category
-    if category not in crud.ALLOWED_CATEGORIES:
-        raise HTTPException(status_code=400, detail="Invalid category")
-    
-    # Update expense
-    expense.amount = amount
-    expense.category = category
-    expense.date = datetime.strptime(date, "%Y-%m-%d").date()
-    expense.description = description
-    
-    db.commit()
-    
     return RedirectResponse("/view-expenses", status_code=303)
 
 @app.get("/delete-expense/{expense_id}")
@@ -325,14 +487,7 @@ def delete_expense(
     if not user:
         return RedirectResponse("/")
     
-    expense = db.query(Expense).filter(
-        Expense.id == expense_id,
-        Expense.user_id == user.id
-    ).first()
-    
-    if expense:
-        db.delete(expense)
-        db.commit()
+    crud.delete_expense(db, expense_id, user_id=user.id)
     
     return RedirectResponse("/view-expenses", status_code=303)
 
@@ -340,31 +495,28 @@ def delete_expense(
 def summary_page(
     request: Request,
     month: Optional[str] = None,
+    currency: str = fx.BASE_CURRENCY,
+    include_archive: bool = False,
     db: Session = Depends(get_db)
 ):
     user = get_current_user(request, db)
     if not user:
         return RedirectResponse("/")
     
-    # Get expenses for the selected month
-    query = db.query(Expense).filter(Expense.user_id == user.id)
+    try:
+        crud.validate_currency(currency)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     if month:
         try:
-            month_num = datetime.strptime(month, "%B").month
-            query = query.filter(func.extract('month', Expense.date) == month_num)
+            datetime.strptime(month, "%B")
         except ValueError:
             # Handle invalid month format
             raise HTTPException(status_code=400, detail="Invalid month format")
     
-    expenses = query.all()
-    
     # Calculate category totals
-    category_totals = {}
-    for expense in expenses:
-        if expense.category not in category_totals:
-            category_totals[expense.category] = 0
-        category_totals[expense.category] += expense.amount
+    category_totals = crud.get_category_totals(db, user.id, month, currency, include_archive)
     
     # Get months for dropdown
     months = [
@@ -372,82 +524,65 @@ def summary_page(
         "July", "August", "September", "October", "November", "December"
     ]
     
-    return templates.TemplateResponse("summary.html", {
+    return render("summary.html", {
         "request": request,
         "category_totals": category_totals,
+        "currency": currency,
+        "currencies": fx.get_rates().currencies(),
+        "include_archive": include_archive,
         "months": months,
         "selected_month": month,
         "categories": list(category_totals.keys()),
         "amounts": list(category_totals.values())
     })
 
-@app.get("/edit-expense/{expense_id}", response_class=HTMLResponse)
-def edit_expense_form(request: Request, expense_id: int, db: Session = Depends(get_db)):
-    # Debugging code
-    from pathlib import Path
-    template_path = Path(__file__).parent / "templates" / "edit_expense.html"
-    print(f"Looking for template at: {template_path}")
-    print(f"Template exists: {template_path.exists()}")
-    
-    user = get_current_user(request, db)
-    if not user:
-        return RedirectResponse("/")
-    
-    expense = db.query(Expense).filter(
-        Expense.id == expense_id,
-        Expense.user_id == user.id
-    ).first()
-    
-    if not expense:
-        raise HTTPException(status_code=404, detail="Expense not found")
-    
-    months = [
-        "January", "February", "March", "April", "May", "June",
-        "July", "August", "September", "October", "November", "December"
-    ]
-    
-    return templates.TemplateResponse("edit_expense.html", {
-        "request": request,
-        "expense": expense,
-        "months": months,
-        "categories": crud.ALLOWED_CATEGORIES
-    })
-
-
-
-@app.post("/update-expense/{expense_id}")
-async def update_expense(
+@app.post("/api/expenses")
+def api_add_expenses(
     request: Request,
-    expense_id: int,
-    month: str = Form(...),  # Add this parameter
-    amount: float = Form(...),
-    category: str = Form(...),
-    date: str = Form(...),
-    description: str = Form(None),
+    expenses: List[schemas.ExpenseCreate],
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
+    """Add a batch of expenses; resending with the same Idempotency-Key header returns the first result"""
     user = get_current_user(request, db)
     if not user:
-        return RedirectResponse("/")
-    
-    expense = db.query(Expense).filter(
-        Expense.id == expense_id,
-        Expense.user_id == user.id
-    ).first()
-    
-    if not expense:
-        raise HTTPException(status_code=404, detail="Expense not found")
-    
-    # Validate category
-    if category not in crud.ALLOWED_CATEGORIES:
-        raise HTTPException(status_code=400, detail="Invalid category")
-    
-    # Update expense
-    expense.amount = amount
-    expense.category = category
-    expense.date = datetime.strptime(date, "%Y-%m-%d").date()
-    expense.description = description
-    
-    db.commit()
-    
-    return RedirectResponse("/view-expenses", status_code=303)
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    try:
+        rows = crud.create_expenses(db, user.id, expenses, idempotency_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"expenses": [{"id": row.id, **changes.expense_data(row)} for row in rows]}
+
+@app.get("/api/changes")
+def api_changes(request: Request, since: int = 0, limit: int = 500, db: Session = Depends(get_db)):
+    """Expense and budget changes after seq `since`; clients pass back `next` until `more` is false"""
+    user = get_current_user(request, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    limit = max(1, min(limit, 1000))
+    entries = changes.get_changes(db, user.id, since, limit)
+    return {
+        "changes": entries,
+        "next": entries[-1]["seq"] if entries else since,
+        "more": len(entries) == limit,
+        # Seqs are per shard: after a move the client must restart from since=0
+        "shard": database.shard_for(user.id),
+        "categories": crud.get_category_names(db, user.id),
+    }
+
+@app.get("/events")
+def event_stream(request: Request, currency: str = fx.BASE_CURRENCY):
+    """Server-sent spend and budget deltas for the logged-in user, in `currency`"""
+    # Only the session is consulted: an open stream must not hold a DB connection
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    try:
+        crud.validate_currency(currency)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(
+        events.stream(user_id, currency),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,173 @@
+"""Schema management: `python migrate.py` brings the database to the latest version.
+
+A fresh database gets the current models via create_all and is stamped with
+the latest version; an existing one runs every migration step above its
+recorded version, in order. Databases created before this script existed
+(tables but no schema_version) are treated as version 1.
+"""
+import argparse
+from datetime import datetime
+
+from sqlalchemy import (
+    Column, Date, DateTime, Float, ForeignKey, Integer, MetaData, String, Table, func, inspect, select, text
+)
+
+import models  # noqa: F401  (registers the tables on Base.metadata)
+from database import Base, get_engine, shard_count
+
+_meta = MetaData()
+schema_version = Table(
+    "schema_version", _meta,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# ---------------------- MIGRATIONS ----------------------
+def _baseline(conn):
+    Base.metadata.create_all(bind=conn)
+
+def _create_budget_alerts(conn):
+    models.BudgetAlert.__table__.create(bind=conn, checkfirst=True)
+
+def _has_column(conn, table, column):
+    return column in {c["name"] for c in inspect(conn).get_columns(table)}
+
+def _add_column(conn, table, column, ddl):
+    if not _has_column(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+# recurring_expenses as migration 3 created it, with the `category` name
+# migration 4 converts; the live model already has category_id
+_v3 = MetaData()
+Table("users", _v3, Column("id", Integer, primary_key=True))
+_recurring_expenses_v3 = Table(
+    "recurring_expenses", _v3,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("amount", Float, nullable=False),
+    Column("category", String(50), nullable=False),
+    Column("description", String(200), nullable=True),
+    Column("frequency", String(10), nullable=False),
+    Column("interval", Integer, nullable=False, default=1),
+    Column("start_date", Date, nullable=False),
+    Column("end_date", Date, nullable=True),
+    Column("next_date", Date, nullable=True, index=True),
+)
+
+def _create_recurring_expenses(conn):
+    _recurring_expenses_v3.create(bind=conn, checkfirst=True)
+    _add_column(conn, "expenses", "recurring_id", "INTEGER NULL REFERENCES recurring_expenses(id)")
+    conn.execute(text("CREATE UNIQUE INDEX uix_recurring_occurrence ON expenses (recurring_id, date)"))
+
+def _categories_table(conn):
+    models.Category.__table__.create(bind=conn, checkfirst=True)
+    # Tables already converted (e.g. recurring_expenses created from the live model) are skipped
+    tables = [table for table in ("expenses", "recurring_expenses") if _has_column(conn, table, "category")]
+    # Every user gets the former fixed list plus any other name already in use
+    conn.execute(text(
+        "INSERT INTO categories (user_id, name) "
+        "SELECT u.id, d.name FROM users u CROSS JOIN ("
+        "SELECT 'Food' AS name UNION ALL SELECT 'Transport' UNION ALL SELECT 'Entertainment' "
+        "UNION ALL SELECT 'Utilities' UNION ALL SELECT 'Shopping') d"
+        + "".join(f" UNION SELECT user_id, category FROM {table}" for table in tables)
+    ))
+    for table in tables:
+        _add_column(conn, table, "category_id", "INTEGER NULL REFERENCES categories(id)")
+        conn.execute(text(
+            f"UPDATE {table} SET category_id = (SELECT c.id FROM categories c "
+            f"WHERE c.user_id = {table}.user_id AND c.name = {table}.category)"
+        ))
+        conn.execute(text(f"ALTER TABLE {table} DROP COLUMN category"))
+        if conn.dialect.name == "mysql":
+            conn.execute(text(f"ALTER TABLE {table} MODIFY category_id INTEGER NOT NULL"))
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD CONSTRAINT fk_{table}_category "
+                f"FOREIGN KEY (category_id) REFERENCES categories(id)"
+            ))
+
+def _currency_columns(conn):
+    for table in ("expenses", "budgets", "recurring_expenses", "budget_alerts"):
+        _add_column(conn, table, "currency", "VARCHAR(3) NOT NULL DEFAULT 'INR'")
+
+def _create_change_log(conn):
+    models.ChangeLog.__table__.create(bind=conn, checkfirst=True)
+
+def _soft_delete_and_archive(conn):
+    _add_column(conn, "expenses", "deleted_at", "DATETIME NULL")
+    if "ix_expenses_user_date" not in {i["name"] for i in inspect(conn).get_indexes("expenses")}:
+        conn.execute(text("CREATE INDEX ix_expenses_user_date ON expenses (user_id, date)"))
+    models.ExpenseArchive.__table__.create(bind=conn, checkfirst=True)
+    models.ExpenseRollup.__table__.create(bind=conn, checkfirst=True)
+
+def _user_shard(conn):
+    _add_column(conn, "users", "shard", "INTEGER NOT NULL DEFAULT 0")
+
+def _expense_idempotency_key(conn):
+    _add_column(conn, "expenses", "idempotency_key", "VARCHAR(80) NULL")
+    if "uix_expense_idempotency_key" not in {i["name"] for i in inspect(conn).get_indexes("expenses")}:
+        conn.execute(text(
+            "CREATE UNIQUE INDEX uix_expense_idempotency_key ON expenses (user_id, idempotency_key)"
+        ))
+
+# (version, description, step); append new steps at the end
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "budget_alerts table", _create_budget_alerts),
+    (3, "recurring expenses", _create_recurring_expenses),
+    (4, "per-user categories referenced by id", _categories_table),
+    (5, "currency on expenses, budgets, recurring expenses and alerts", _currency_columns),
+    (6, "change_log table", _create_change_log),
+    (7, "soft-deleted expenses, archive and rollups", _soft_delete_and_archive),
+    (8, "shard assignment on users", _user_shard),
+    (9, "idempotency keys on expenses", _expense_idempotency_key),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# ---------------------- RUNNER ----------------------
+def current_version(conn):
+    tables = inspect(conn)
+    if not tables.has_table("schema_version"):
+        return 1 if tables.has_table("users") else 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+def _stamp(conn, version, description):
+    conn.execute(schema_version.insert().values(
+        version=version, description=description, applied_at=datetime.utcnow()
+    ))
+
+def upgrade(engine=None):
+    """Apply pending migrations; returns the (old, new) schema versions"""
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        version = current_version(conn)
+        _meta.create_all(bind=conn)
+        if version == 0:
+            Base.metadata.create_all(bind=conn)
+            _stamp(conn, LATEST_VERSION, "initial schema")
+            return 0, LATEST_VERSION
+        if version == 1 and conn.execute(select(func.count()).select_from(schema_version)).scalar() == 0:
+            _stamp(conn, 1, MIGRATIONS[0][1])
+        for number, description, step in MIGRATIONS:
+            if number > version:
+                step(conn)
+                _stamp(conn, number, description)
+    return version, LATEST_VERSION
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--status", action="store_true", help="only print the current schema version")
+    args = parser.parse_args()
+    # Every shard carries the full schema
+    for shard in range(shard_count()):
+        prefix = f"shard {shard}: " if shard_count() > 1 else ""
+        if args.status:
+            with get_engine(shard).connect() as conn:
+                print(f"{prefix}schema version {current_version(conn)} (latest {LATEST_VERSION})")
+            continue
+        old, new = upgrade(get_engine(shard))
+        print(f"{prefix}schema version {old} -> {new}")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, Text, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -8,10 +8,27 @@ class User(Base):
     name = Column(String(100), nullable=False)
     email = Column(String(100), unique=True, index=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
+    shard = Column(Integer, nullable=False, default=0, server_default="0")  # authoritative on the primary only
 
     # Relationships
     expenses = relationship("Expense", back_populates="user", cascade="all, delete-orphan")
     budgets = relationship("Budget", back_populates="user", cascade="all, delete-orphan")
+    recurring_expenses = relationship("RecurringExpense", back_populates="user", cascade="all, delete-orphan")
+    categories = relationship("Category", back_populates="user", cascade="all, delete-orphan")
+
+
+class Category(Base):
+    __tablename__ = "categories"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    name = Column(String(50), nullable=False)
+
+    # Relationship
+    user = relationship("User", back_populates="categories")
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "name", name="uix_user_category"),
+    )
     
 
 class Expense(Base):
@@ -19,13 +36,61 @@ class Expense(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     amount = Column(Float, nullable=False)
-    category = Column(String(50), nullable=False)  
+    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    currency = Column(String(3), nullable=False, default="INR", server_default="INR")  # ISO 4217 code
     date = Column(Date, nullable=False)
     description = Column(String(200), nullable=True)
+    recurring_id = Column(Integer, ForeignKey("recurring_expenses.id"), nullable=True)  # set on generated occurrences
+    deleted_at = Column(DateTime, nullable=True)  # soft delete; live queries filter on NULL
+    idempotency_key = Column(String(80), nullable=True)  # client request key, see crud.create_expense
 
     # Relationship
     user = relationship("User", back_populates="expenses")
 
+    # One generated row per rule and date, so re-running the scheduler is harmless
+    __table_args__ = (
+        UniqueConstraint("recurring_id", "date", name="uix_recurring_occurrence"),
+        Index("ix_expenses_user_date", "user_id", "date"),
+        # A retried create finds its first row instead of inserting another
+        UniqueConstraint("user_id", "idempotency_key", name="uix_expense_idempotency_key"),
+    )
+
+
+# Expenses older than the archive horizon, moved out of the hot table by archive.py
+class ExpenseArchive(Base):
+    __tablename__ = "expenses_archive"
+    id = Column(Integer, primary_key=True)  # same id the row had in expenses
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    amount = Column(Float, nullable=False)
+    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    currency = Column(String(3), nullable=False, default="INR", server_default="INR")
+    date = Column(Date, nullable=False)
+    description = Column(String(200), nullable=True)
+    recurring_id = Column(Integer, nullable=True)
+    deleted_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_expenses_archive_user_date", "user_id", "date"),
+    )
+
+
+# Per-month totals of archived (non-deleted) expenses, so summaries never scan the archive
+class ExpenseRollup(Base):
+    __tablename__ = "expense_rollups"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)  # 1-12
+    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    currency = Column(String(3), nullable=False)
+    total = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "year", "month", "category_id", "currency", name="uix_rollup_key"),
+    )
+
 
 class Budget(Base):
     __tablename__ = "budgets"
@@ -34,6 +99,7 @@ class Budget(Base):
     month = Column(String(20), nullable=False)  # e.g., 'January'
     year = Column(Integer, nullable=False)
     amount = Column(Float, nullable=False)
+    currency = Column(String(3), nullable=False, default="INR", server_default="INR")
 
     # Relationship
     user = relationship("User", back_populates="budgets")
@@ -42,3 +108,55 @@ class Budget(Base):
     __table_args__ = (
         UniqueConstraint("user_id", "month", "year", name="uix_user_month_year"),
     )
+
+
+class BudgetAlert(Base):
+    __tablename__ = "budget_alerts"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)  # 1-12
+    threshold = Column(Integer, nullable=False)  # percent of the budget, e.g. 80
+    spent = Column(Float, nullable=False)
+    budget = Column(Float, nullable=False)
+    currency = Column(String(3), nullable=False, default="INR", server_default="INR")  # of spent/budget
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "year", "month", "threshold", name="uix_alert_user_month_threshold"),
+    )
+
+
+class RecurringExpense(Base):
+    __tablename__ = "recurring_expenses"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    amount = Column(Float, nullable=False)
+    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    currency = Column(String(3), nullable=False, default="INR", server_default="INR")
+    description = Column(String(200), nullable=True)
+    frequency = Column(String(10), nullable=False)  # 'daily', 'weekly' or 'monthly'
+    interval = Column(Integer, nullable=False, default=1)  # every N days/weeks/months
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=True)
+    next_date = Column(Date, nullable=True, index=True)  # first occurrence not yet materialized; NULL when finished
+
+    # Relationship
+    user = relationship("User", back_populates="recurring_expenses")
+
+
+# Append-only record of expense and budget writes, for incremental client sync
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    seq = Column(Integer, primary_key=True, autoincrement=True)  # monotonic; clients resume from the last seen seq
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    entity = Column(String(20), nullable=False)  # 'expense' or 'budget'
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(10), nullable=False)  # 'upsert' or 'delete'
+    data = Column(Text, nullable=True)  # JSON of the row after the write; NULL for deletes
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_change_log_user_seq", "user_id", "seq"),
+        Index("ix_change_log_entity", "entity", "entity_id", "seq"),
+    )
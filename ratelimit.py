@@ -0,0 +1,203 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse
+
+# `capacity` requests in a burst, refilled evenly over `per` seconds
+Limit = namedtuple("Limit", "capacity per")
+
+# Per client IP, checked by the middleware before the request body is read
+AUTH_LIMIT = Limit(capacity=20, per=60)
+WRITE_LIMIT = Limit(capacity=120, per=60)
+# Per email address, checked by /login and /register before any password hashing
+ACCOUNT_LIMIT = Limit(capacity=5, per=300)
+
+AUTH_PATHS = ("/login", "/register")
+
+
+def _refill(tokens, updated_at, limit: Limit, now):
+    return min(limit.capacity, tokens + (now - updated_at) * limit.capacity / limit.per)
+
+
+def _take(tokens, limit: Limit):
+    """(tokens left, seconds until full, seconds to wait) after trying to take one token"""
+    if tokens >= 1:
+        tokens -= 1
+        wait = 0.0
+    else:
+        wait = (1 - tokens) * limit.per / limit.capacity
+    return tokens, (limit.capacity - tokens) * limit.per / limit.capacity, wait
+
+
+# ---------------------- STORES ----------------------
+class MemoryBuckets:
+    """Token buckets for a single process.
+
+    A bucket is a (tokens, updated_at, full_at) tuple. A bucket that has
+    refilled completely behaves exactly like a missing one, so it is
+    dropped lazily on lookup and in batches from the front of the
+    (last-touched ordered) dict at most once every `purge_interval` seconds.
+    """
+
+    # Whether take() does I/O and should run off the event loop
+    blocking = False
+
+    def __init__(self, max_entries: int = 100_000, purge_interval: int = 60):
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at, full_at)
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + purge_interval
+
+    def take(self, key: str, limit: Limit):
+        """Take one token; returns 0 when allowed, else the seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket[2] <= now:
+                tokens = limit.capacity
+            else:
+                tokens = _refill(bucket[0], bucket[1], limit, now)
+            tokens, until_full, wait = _take(tokens, limit)
+            self._buckets[key] = (tokens, now, now + until_full)
+            self._buckets.move_to_end(key)
+            if now >= self._next_purge:
+                self._purge(now)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def _purge(self, now):
+        while self._buckets:
+            key, (_, _, full_at) = next(iter(self._buckets.items()))
+            if full_at > now:
+                break
+            del self._buckets[key]
+        self._next_purge = now + self.purge_interval
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def close(self):
+        pass
+
+
+class SQLiteBuckets(MemoryBuckets):
+    """Token buckets shared by all workers on a host through a local SQLite file.
+
+    Each take is one read and one write inside an IMMEDIATE transaction, so
+    concurrent workers cannot both spend the last token. Full buckets are
+    deleted in one statement every `purge_interval` seconds.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, purge_interval: int = 300):
+        super().__init__(purge_interval=purge_interval)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, full_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._next_purge = time.time() + purge_interval
+
+    def take(self, key, limit):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at, full_at FROM rate_buckets WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[2] <= now:
+                    tokens = limit.capacity
+                else:
+                    tokens = _refill(row[0], row[1], limit, now)
+                tokens, until_full, wait = _take(tokens, limit)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                    (key, tokens, now, now + until_full),
+                )
+                if now >= self._next_purge:
+                    self._conn.execute("DELETE FROM rate_buckets WHERE full_at <= ?", (now,))
+                    self._next_purge = now + self.purge_interval
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_buckets")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_buckets(backend: str = "memory", path: str = "ratelimit.db"):
+    """Build the configured bucket store ("memory" or "sqlite")"""
+    if backend == "memory":
+        return MemoryBuckets()
+    if backend == "sqlite":
+        return SQLiteBuckets(path)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+def too_many_requests(wait: float):
+    return PlainTextResponse(
+        "Too many requests, try again later", status_code=429,
+        headers={"Retry-After": str(int(wait) + 1)},
+    )
+
+
+# ---------------------- MIDDLEWARE ----------------------
+class RateLimitMiddleware:
+    """Per-IP token buckets in front of the login/register forms and other POSTs.
+
+    Runs before routing and before the body is read, so a rejected request
+    costs one bucket update and never reaches password hashing or the
+    database. Per-account limits need the submitted email and are checked
+    in the routes via `check_account`.
+    """
+
+    def __init__(self, app, buckets: MemoryBuckets):
+        self.app = app
+        self.buckets = buckets
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        ip = client[0] if client else "unknown"
+        if scope["path"] in AUTH_PATHS:
+            wait = await self._take("ip-auth:" + ip, AUTH_LIMIT)
+        else:
+            wait = await self._take("ip-write:" + ip, WRITE_LIMIT)
+        if wait:
+            await too_many_requests(wait)(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+    async def _take(self, key, limit):
+        # A memory bucket is a dict update; a thread hop would cost more than it saves
+        if self.buckets.blocking:
+            return await run_in_threadpool(self.buckets.take, key, limit)
+        return self.buckets.take(key, limit)
+
+
+def check_account(buckets: MemoryBuckets, email: str):
+    """A 429 response if `email` has used up its attempts, else None"""
+    wait = buckets.take("account:" + email.strip().lower(), ACCOUNT_LIMIT)
+    return too_many_requests(wait) if wait else None
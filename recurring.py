@@ -0,0 +1,193 @@
+import calendar
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import changes
+import crud
+import fx
+import models
+import scheduler
+
+FREQUENCIES = ["daily", "weekly", "monthly"]
+
+# Rules handled per transaction by the scheduler
+BATCH_SIZE = 200
+
+
+def _add_months(day: date, months: int, anchor_day: int):
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(anchor_day, calendar.monthrange(year, month)[1]))
+
+
+def next_occurrence(rule, day: date):
+    """The occurrence following `day` (monthly rules stick to the start day, clamped to month end)"""
+    if rule.frequency == "daily":
+        return day + timedelta(days=rule.interval)
+    if rule.frequency == "weekly":
+        return day + timedelta(weeks=rule.interval)
+    return _add_months(day, rule.interval, rule.start_date.day)
+
+
+def occurrences(rule, until: date):
+    """Occurrence dates from rule.next_date up to and including `until`"""
+    day = rule.next_date
+    last = min(until, rule.end_date) if rule.end_date else until
+    while day is not None and day <= last:
+        yield day
+        day = next_occurrence(rule, day)
+
+
+# ---------------------- RULES ----------------------
+def create_rule(db: Session, user_id: int, amount: float, category: str, description: str,
+                frequency: str, interval: int, start_date: date, end_date: date = None,
+                currency: str = fx.BASE_CURRENCY):
+    if frequency not in FREQUENCIES:
+        raise ValueError(f"Invalid frequency. Allowed frequencies: {FREQUENCIES}")
+    if interval < 1:
+        raise ValueError("Interval must be at least 1")
+    rule = models.RecurringExpense(
+        user_id=user_id, amount=amount, category_id=crud.get_category_id(db, user_id, category),
+        currency=crud.validate_currency(currency), description=description,
+        frequency=frequency, interval=interval, start_date=start_date, end_date=end_date,
+        next_date=start_date
+    )
+    db.add(rule)
+    db.commit()
+    db.refresh(rule)
+    # Catch up on past-dated rules right away instead of waiting for the scheduler
+    materialize_due(db, date.today(), user_id=user_id)
+    return rule
+
+
+def get_rules(db: Session, user_id: int):
+    return db.query(models.RecurringExpense)\
+        .filter(models.RecurringExpense.user_id == user_id)\
+        .order_by(models.RecurringExpense.start_date)\
+        .all()
+
+
+def delete_rule(db: Session, user_id: int, rule_id: int):
+    """Delete a rule; expenses it already generated are kept as normal expenses"""
+    rule = db.query(models.RecurringExpense).filter(
+        models.RecurringExpense.id == rule_id,
+        models.RecurringExpense.user_id == user_id
+    ).first()
+    if not rule:
+        return False
+    db.query(models.Expense)\
+        .filter(models.Expense.recurring_id == rule_id)\
+        .update({models.Expense.recurring_id: None}, synchronize_session=False)
+    db.delete(rule)
+    db.commit()
+    return True
+
+
+# ---------------------- MATERIALIZATION ----------------------
+def materialize_due(db: Session, today: date, user_id: int = None):
+    """Insert every due occurrence up to `today`; returns the number of rows inserted.
+
+    Rules are locked (SKIP LOCKED where supported) so concurrent workers
+    split the work, and the (recurring_id, date) unique constraint makes a
+    rerun after a crash between insert and next_date update a no-op.
+    """
+    inserted, conflicts = 0, 0
+    while True:
+        query = db.query(models.RecurringExpense).filter(
+            models.RecurringExpense.next_date != None,  # noqa: E711
+            models.RecurringExpense.next_date <= today
+        )
+        if user_id is not None:
+            query = query.filter(models.RecurringExpense.user_id == user_id)
+        rules = query.order_by(models.RecurringExpense.id)\
+            .limit(BATCH_SIZE)\
+            .with_for_update(skip_locked=True)\
+            .all()
+        if not rules:
+            return inserted
+
+        # Occurrences already stored for this batch, in one query
+        existing = set(
+            db.query(models.Expense.recurring_id, models.Expense.date).filter(
+                models.Expense.recurring_id.in_([rule.id for rule in rules]),
+                models.Expense.date >= min(rule.next_date for rule in rules)
+            )
+        )
+        rows, touched = [], {}
+        for rule in rules:
+            days = list(occurrences(rule, today))
+            for day in days:
+                if (rule.id, day) not in existing:
+                    rows.append({
+                        "user_id": rule.user_id, "amount": rule.amount, "currency": rule.currency,
+                        "category_id": rule.category_id,
+                        "date": day, "description": rule.description, "recurring_id": rule.id
+                    })
+                    touched.setdefault(rule.user_id, set()).add((day.year, day.month))
+            rule.next_date = next_occurrence(rule, days[-1]) if days else None
+            if rule.next_date and rule.end_date and rule.next_date > rule.end_date:
+                rule.next_date = None
+
+        try:
+            if rows:
+                db.execute(insert(models.Expense), rows)
+                _log_inserted(db, rows)
+            db.commit()
+        except IntegrityError:
+            # Another worker materialized the same occurrences first; retry the batch
+            db.rollback()
+            conflicts += 1
+            if conflicts > 3:
+                raise
+            continue
+        inserted += len(rows)
+        for owner_id, months in touched.items():
+            crud.expenses_bulk_written(db, owner_id, months)
+
+
+def _log_inserted(db: Session, rows):
+    """Change log entries for just-inserted occurrences (executemany returns no ids)"""
+    keys = {(row["recurring_id"], row["date"]) for row in rows}
+    inserted = db.query(models.Expense).filter(
+        models.Expense.recurring_id.in_({rule_id for rule_id, _ in keys}),
+        models.Expense.date >= min(day for _, day in keys)
+    ).all()
+    by_user = {}
+    for expense in inserted:
+        if (expense.recurring_id, expense.date) in keys:
+            by_user.setdefault(expense.user_id, []).append(
+                ("expense", expense.id, "upsert", changes.expense_data(expense))
+            )
+    # Lock users in id order so concurrent workers cannot deadlock
+    for owner_id in sorted(by_user):
+        changes.log_changes(db, owner_id, by_user[owner_id])
+
+
+@scheduler.job("recurring_expenses", interval=3600)
+def materialize_job(db: Session):
+    return materialize_due(db, date.today())
+
+
+# ---------------------- VIRTUAL READS ----------------------
+def virtual_occurrences(db: Session, user_id: int, start: date, end: date):
+    """Expense-like objects for occurrences in [start, end] that are not stored yet"""
+    rules = db.query(models.RecurringExpense).filter(
+        models.RecurringExpense.user_id == user_id,
+        models.RecurringExpense.next_date != None,  # noqa: E711
+        models.RecurringExpense.next_date <= end
+    ).all()
+    upcoming = []
+    for rule in rules:
+        for day in occurrences(rule, end):
+            if day >= start:
+                upcoming.append(SimpleNamespace(
+                    id=None, user_id=user_id, amount=rule.amount, currency=rule.currency,
+                    category_id=rule.category_id,
+                    date=day, description=rule.description, recurring_id=rule.id, virtual=True
+                ))
+    upcoming.sort(key=lambda e: e.date, reverse=True)
+    return upcoming
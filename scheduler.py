@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+from database import open_session, shard_count
+
+logger = logging.getLogger(__name__)
+
+# name -> (interval in seconds, fn(db)); filled by the @job decorator
+JOBS = {}
+
+
+def job(name: str, interval: int):
+    """Register a function to run every `interval` seconds with its own DB session.
+
+    Every worker runs every job, so jobs must be idempotent and cheap when
+    there is nothing to do.
+    """
+    def register(fn):
+        JOBS[name] = (interval, fn)
+        return fn
+    return register
+
+
+def run_job(name: str):
+    """Run a job once on every shard; returns the per-shard results"""
+    results = []
+    for shard in range(shard_count()):
+        db = open_session(shard)
+        try:
+            results.append(JOBS[name][1](db))
+        finally:
+            db.close()
+    return results
+
+
+async def _loop(name, interval):
+    while True:
+        try:
+            await run_in_threadpool(run_job, name)
+        except Exception:
+            logger.exception("Scheduled job %s failed", name)
+        await asyncio.sleep(interval)
+
+
+def start():
+    """Start all registered jobs unless SCHEDULER_ENABLED=0; returns the tasks"""
+    if os.getenv("SCHEDULER_ENABLED", "1") == "0":
+        return []
+    return [asyncio.create_task(_loop(name, interval)) for name, (interval, _) in JOBS.items()]
+
+
+async def stop(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,7 +1,9 @@
 from pydantic import BaseModel, Field
-from typing import Literal, Optional
+from typing import Optional
 from datetime import date
 
+import fx
+
 # ------------------ User Schemas ------------------
 
 class UserCreate(BaseModel):
@@ -22,14 +24,16 @@ class UserOut(BaseModel):
 class ExpenseCreate(BaseModel):
     date: date  # Only one field instead of year/month/day
     amount: float
-    category: Literal["a1", "b2", "c3", "d4", "e5"]
+    category: str  # name of one of the user's categories, resolved by crud
+    currency: str = fx.BASE_CURRENCY  # ISO 4217 code
     description: Optional[str] = ""
 
 class ExpenseOut(BaseModel):
     id: int
     date: date
     amount: float
-    category: str
+    category_id: int
+    currency: str
     description: Optional[str] = ""
 
     class Config:
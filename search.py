@@ -0,0 +1,150 @@
+import re
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy.orm import Session
+
+import cache
+import models
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+MAX_INDEXED_USERS = 256
+
+
+def tokenize(text: str):
+    return set(_TOKEN.findall(text.lower())) if text else set()
+
+
+class ExpenseIndex:
+    """Inverted index over one user's expense descriptions.
+
+    `docs` holds only what filtering and ordering need, so a search never
+    touches the database until the requested page is fetched. Tokens are
+    also kept sorted, which turns a prefix lookup into a bisect + range scan.
+    `lock` is held while searching and while patching, as writes mutate the
+    dicts a search iterates.
+    """
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.lock = threading.Lock()
+        self.docs = {}  # expense_id -> (date, category_id, tokens)
+        self.postings = {}  # token -> set of expense ids
+        self.tokens = []  # sorted keys of postings
+        for expense_id, description, category_id, day in rows:
+            self._add(expense_id, description, category_id, day, keep_sorted=False)
+        self.tokens = sorted(self.postings)
+
+    def _add(self, expense_id, description, category_id, day, keep_sorted=True):
+        tokens = tokenize(description)
+        self.docs[expense_id] = (day, category_id, tokens)
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                if keep_sorted:
+                    insort(self.tokens, token)
+            ids.add(expense_id)
+
+    def remove(self, expense_id):
+        doc = self.docs.pop(expense_id, None)
+        if doc is None:
+            return
+        for token in doc[2]:
+            ids = self.postings[token]
+            ids.discard(expense_id)
+            if not ids:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def put(self, expense_id, description, category_id, day):
+        self.remove(expense_id)
+        self._add(expense_id, description, category_id, day)
+
+    def _matching(self, term):
+        """Ids whose description has a word starting with `term`"""
+        start = bisect_left(self.tokens, term)
+        end = bisect_left(self.tokens, term + "\uffff", start)
+        if end - start == 1:
+            return self.postings[self.tokens[start]]
+        ids = set()
+        for token in self.tokens[start:end]:
+            ids |= self.postings[token]
+        return ids
+
+    def search(self, query: str = "", category_id: int = None, date_from=None, date_to=None):
+        """Matching expense ids, newest first; every query word is a prefix match"""
+        with self.lock:
+            return self._search(query, category_id, date_from, date_to)
+
+    def _search(self, query, category_id, date_from, date_to):
+        terms = sorted(tokenize(query))
+        if terms:
+            matches = sorted((self._matching(term) for term in terms), key=len)
+            ids = set(matches[0])
+            for other in matches[1:]:
+                ids &= other
+                if not ids:
+                    break
+        else:
+            ids = self.docs.keys()
+
+        docs = self.docs
+        hits = []
+        for expense_id in ids:
+            day, doc_category, _ = docs[expense_id]
+            if category_id is not None and doc_category != category_id:
+                continue
+            if date_from and day < date_from:
+                continue
+            if date_to and day > date_to:
+                continue
+            hits.append((day, expense_id))
+        hits.sort(reverse=True)
+        return [expense_id for _, expense_id in hits]
+
+
+_indexes = cache.UserStates(maxsize=MAX_INDEXED_USERS)
+
+
+def _build(db: Session, user_id: int, version: int):
+    rows = db.query(
+        models.Expense.id, models.Expense.description, models.Expense.category_id, models.Expense.date
+    ).filter(models.Expense.user_id == user_id, models.Expense.deleted_at.is_(None)).all()
+    return ExpenseIndex(version, rows)
+
+
+def get_index(db: Session, user_id: int, version: int):
+    index = _indexes.get(user_id, version)
+    if index is None:
+        index = _build(db, user_id, version)
+        _indexes.put(user_id, index)
+    return index
+
+
+def _patch(index, before, after):
+    if after is not None:
+        index.put(after.id, after.description, after.category_id, after.date)
+    elif before is not None:
+        index.remove(before.id)
+
+
+def expense_written(user_id: int, version: int, before=None, after=None):
+    _indexes.patch(user_id, version, lambda index: _patch(index, before, after))
+
+
+def search_expenses(db: Session, user_id: int, version: int, query: str = "", category_id: int = None,
+                    date_from=None, date_to=None, page: int = 1, per_page: int = 50):
+    """One page of matching Expense rows plus the total number of hits"""
+    ids = get_index(db, user_id, version).search(query, category_id, date_from, date_to)
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    if not page_ids:
+        return [], len(ids)
+    rows = {
+        e.id: e for e in db.query(models.Expense).filter(
+            models.Expense.user_id == user_id,
+            models.Expense.id.in_(page_ids)
+        )
+    }
+    return [rows[i] for i in page_ids if i in rows], len(ids)
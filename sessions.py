@@ -0,0 +1,247 @@
+import json
+import secrets
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+
+# ---------------------- STORES ----------------------
+class SessionStore(ABC):
+    """Server-side session storage keyed by an opaque session id"""
+
+    # Stores doing file or network I/O are called from a worker thread, never on the event loop
+    blocking = False
+
+    @abstractmethod
+    def get(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def set(self, session_id: str, data: dict):
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        ...
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Single-node store: LRU ordered dict with sliding TTL.
+
+    Entries are kept in last-access order, and since every access also
+    refreshes the expiry, the oldest entries are always at the front.
+    Expired entries are dropped lazily on lookup and in batches from the
+    front of the dict, at most once every `purge_interval` seconds.
+    """
+
+    def __init__(self, ttl: int = 14 * 24 * 3600, max_entries: int = 100_000, purge_interval: int = 60):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        self._entries = OrderedDict()  # session_id -> (expires_at, data)
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + purge_interval
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[session_id]
+                return None
+            self._entries[session_id] = (now + self.ttl, entry[1])
+            self._entries.move_to_end(session_id)
+            return dict(entry[1])
+
+    def set(self, session_id, data):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[session_id] = (now + self.ttl, dict(data))
+            self._entries.move_to_end(session_id)
+            if now >= self._next_purge:
+                self._purge(now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def _purge(self, now):
+        while self._entries:
+            session_id, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[session_id]
+        self._next_purge = now + self.purge_interval
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store shared by all workers on a host through a local SQLite file.
+
+    The expiry is only pushed forward on read once less than half of the
+    TTL is left, so most requests cost a single primary-key SELECT.
+    Expired rows are deleted in one statement every `purge_interval` seconds.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, ttl: int = 14 * 24 * 3600, purge_interval: int = 300):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._next_purge = time.time() + purge_interval
+
+    def get(self, session_id):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, expires_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            data, expires_at = row
+            if expires_at <= now:
+                self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                return None
+            if expires_at - now < self.ttl / 2:
+                self._conn.execute(
+                    "UPDATE sessions SET expires_at = ? WHERE id = ?", (now + self.ttl, session_id)
+                )
+        return json.loads(data)
+
+    def set(self, session_id, data):
+        now = time.time()
+        payload = json.dumps(data, separators=(",", ":"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, payload, now + self.ttl),
+            )
+            if now >= self._next_purge:
+                self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+                self._next_purge = now + self.purge_interval
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ---------------------- MIDDLEWARE ----------------------
+class ServerSessionMiddleware:
+    """Drop-in replacement for starlette's SessionMiddleware.
+
+    The cookie only carries a random 128-bit session id, so there is no
+    payload to decode or signature to verify, and clearing the session
+    (logout) revokes it on the server. The store and the cookie are only
+    written when the session content actually changed during the request,
+    or, like the SQLite store's expiry, once less than half of the cookie's
+    Max-Age is left, so active users stay logged in.
+    """
+
+    # Private entry in the stored data: when the cookie was last issued (epoch seconds)
+    ISSUED_KEY = "_cookie_issued_at"
+
+    def __init__(
+        self,
+        app,
+        store: SessionStore,
+        session_cookie: str = "session",
+        max_age: int = 14 * 24 * 3600,
+        path: str = "/",
+        same_site: str = "lax",
+        https_only: bool = False,
+    ):
+        self.app = app
+        self.store = store
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.path = path
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only:
+            self.security_flags += "; secure"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        connection = HTTPConnection(scope)
+        session_id = connection.cookies.get(self.session_cookie)
+        initial = await self._call(self.store.get, session_id) if session_id else None
+        if initial is None:
+            session_id = None
+            initial = {}
+        issued_at = initial.pop(self.ISSUED_KEY, None)
+        scope["session"] = dict(initial)
+
+        async def send_wrapper(message):
+            nonlocal session_id
+            if message["type"] == "http.response.start":
+                session = scope["session"]
+                headers = MutableHeaders(scope=message)
+                if session:
+                    now = time.time()
+                    if session != initial:
+                        # Issue a fresh id on every change (i.e. login) to avoid fixation
+                        if session_id is not None:
+                            await self._call(self.store.delete, session_id)
+                        session_id = secrets.token_urlsafe(16)
+                        await self._call(self.store.set, session_id, {**session, self.ISSUED_KEY: now})
+                        headers.append("Set-Cookie", self._cookie(session_id, self.max_age))
+                    elif self.max_age and (issued_at is None or now - issued_at >= self.max_age / 2):
+                        # Same id, fresh Max-Age: the browser would otherwise drop it max_age after login
+                        await self._call(self.store.set, session_id, {**session, self.ISSUED_KEY: now})
+                        headers.append("Set-Cookie", self._cookie(session_id, self.max_age))
+                elif session_id is not None:
+                    await self._call(self.store.delete, session_id)
+                    headers.append(
+                        "Set-Cookie",
+                        self._cookie("null", None) + "; expires=Thu, 01 Jan 1970 00:00:00 GMT",
+                    )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _call(self, fn, *args):
+        # The in-memory store is a dict lookup; a thread hop would cost more than it saves
+        if self.store.blocking:
+            return await run_in_threadpool(fn, *args)
+        return fn(*args)
+
+    def _cookie(self, value, max_age):
+        cookie = f"{self.session_cookie}={value}; path={self.path}; "
+        if max_age:
+            cookie += f"Max-Age={max_age}; "
+        return cookie + self.security_flags
+
+
+def create_session_store(backend: str = "memory", path: str = "sessions.db", ttl: int = 14 * 24 * 3600):
+    """Build the configured session store ("memory" or "sqlite")"""
+    if backend == "memory":
+        return MemorySessionStore(ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteSessionStore(path, ttl=ttl)
+    raise ValueError(f"Unknown session backend: {backend}")
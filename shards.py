@@ -0,0 +1,176 @@
+"""Shard administration: `python shards.py move USER_ID SHARD` or `python shards.py totals`.
+
+Moving a user copies every row they own to the target shard with fresh
+ids (ids are only unique per shard), points the primary's users.shard at
+the target and deletes the rows from the source. Archived expenses are
+copied back into the target's hot table; the archival job re-archives
+them and rebuilds their rollups there. The change log is not copied: the
+target gets one upsert entry per live expense and budget, so sync clients
+must restart from since=0 (the `shard` in /api/changes tells them).
+"""
+import argparse
+from datetime import datetime
+
+from sqlalchemy import func
+
+import cache
+import changes
+import database
+import models
+
+# Per-user tables in foreign-key order, with the columns that reference
+# another copied table: {column: source model}
+_COPY_ORDER = [
+    (models.Category, {}),
+    (models.RecurringExpense, {"category_id": models.Category}),
+    (models.Expense, {"category_id": models.Category, "recurring_id": models.RecurringExpense}),
+    (models.Budget, {}),
+    (models.BudgetAlert, {}),
+]
+
+_DELETE_ORDER = [
+    models.ChangeLog, models.BudgetAlert, models.ExpenseRollup, models.ExpenseArchive,
+    models.Expense, models.RecurringExpense, models.Budget, models.Category,
+]
+
+
+def _values(row, skip=("id",)):
+    return {c.key: getattr(row, c.key) for c in row.__table__.columns if c.key not in skip}
+
+
+def _copy(source, target, user_id):
+    id_maps = {}
+    for model, references in _COPY_ORDER:
+        rows = source.query(model).filter(model.user_id == user_id).order_by(model.id).all()
+        copies = []
+        for row in rows:
+            values = _values(row)
+            for column, referenced in references.items():
+                if values[column] is not None:
+                    values[column] = id_maps[referenced][values[column]]
+            copies.append(model(**values))
+        target.add_all(copies)
+        target.flush()
+        id_maps[model] = {row.id: copy.id for row, copy in zip(rows, copies)}
+
+    # Archived rows become hot rows again; recurring ids of deleted rules are dropped
+    archived = source.query(models.ExpenseArchive).filter(models.ExpenseArchive.user_id == user_id).all()
+    target.add_all(
+        models.Expense(**{
+            **_values(row, skip=("id", "archived_at")),
+            "category_id": id_maps[models.Category][row.category_id],
+            "recurring_id": id_maps[models.RecurringExpense].get(row.recurring_id),
+        })
+        for row in archived
+    )
+    target.flush()
+
+
+def move_user(user_id: int, target_shard: int):
+    """Move all of a user's rows to `target_shard`; returns the source shard.
+
+    Refused unless cache versions are shared (CACHE_VERSIONS_PATH): the bump
+    that follows the move is the only way running workers learn of it.
+    """
+    if not cache.versions.shared:
+        raise ValueError("Set CACHE_VERSIONS_PATH to the running workers' version file before moving users")
+    primary = database.open_session(0)
+    source_shard = primary.query(models.User.shard).filter(models.User.id == user_id).scalar()
+    if source_shard is None:
+        raise ValueError(f"No user {user_id}")
+    if source_shard == target_shard:
+        return source_shard
+    source = database.open_session(source_shard)
+    target = database.open_session(target_shard)
+    try:
+        # Held until the source rows are gone: concurrent writes wait, then fail
+        # database.check_shard instead of landing on the old shard
+        user = source.query(models.User).filter(models.User.id == user_id).with_for_update().one()
+        if target.query(models.Category.id).filter(models.Category.user_id == user_id).first():
+            raise ValueError(f"Shard {target_shard} already has rows of user {user_id}; clean up a failed move first")
+
+        if target_shard != 0:
+            target.add(models.User(**{**_values(user, skip=()), "password_hash": "!", "shard": target_shard}))
+            target.flush()
+        _copy(source, target, user_id)
+        changes.insert_changes(
+            target, user_id,
+            [("expense", e.id, "upsert", changes.expense_data(e)) for e in target.query(models.Expense).filter(
+                models.Expense.user_id == user_id, models.Expense.deleted_at.is_(None)
+            )] + [("budget", b.id, "upsert", changes.budget_data(b)) for b in target.query(models.Budget).filter(
+                models.Budget.user_id == user_id
+            )]
+        )
+        target.commit()
+
+        primary.query(models.User).filter(models.User.id == user_id).update({models.User.shard: target_shard})
+        primary.commit()
+        cache.user_changed(user_id)
+
+        for model in _DELETE_ORDER:
+            source.query(model).filter(model.user_id == user_id).delete(synchronize_session=False)
+        if source_shard != 0:
+            source.query(models.User).filter(models.User.id == user_id).delete(synchronize_session=False)
+        source.commit()
+        return source_shard
+    except Exception:
+        source.rollback()
+        target.rollback()
+        raise
+    finally:
+        primary.close()
+        source.close()
+        target.close()
+
+
+def _shard_totals(db):
+    spent = dict(
+        db.query(models.Expense.currency, func.sum(models.Expense.amount))
+        .filter(models.Expense.deleted_at.is_(None))
+        .group_by(models.Expense.currency)
+        .all()
+    )
+    return {
+        "users": db.query(func.count(func.distinct(models.Category.user_id))).scalar(),
+        "expenses": db.query(func.count(models.Expense.id)).filter(models.Expense.deleted_at.is_(None)).scalar(),
+        "spent": spent,
+    }
+
+
+def get_totals():
+    """Per-shard and overall totals, queried on every shard in parallel"""
+    per_shard = database.fan_out(_shard_totals)
+    overall = {"users": 0, "expenses": 0, "spent": {}}
+    for totals in per_shard:
+        overall["users"] += totals["users"]
+        overall["expenses"] += totals["expenses"]
+        for currency, amount in totals["spent"].items():
+            overall["spent"][currency] = overall["spent"].get(currency, 0) + amount
+    return per_shard, overall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    move = commands.add_parser("move", help="move a user's rows to another shard")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard", type=int, choices=range(database.shard_count()))
+    commands.add_parser("totals", help="users, expenses and spend per shard")
+    args = parser.parse_args()
+
+    if args.command == "move":
+        started = datetime.now()
+        try:
+            source = move_user(args.user_id, args.shard)
+        except ValueError as e:
+            parser.exit(1, f"{e}\n")
+        print(f"user {args.user_id}: shard {source} -> {args.shard} in {datetime.now() - started}")
+    else:
+        per_shard, overall = get_totals()
+        for shard, totals in enumerate(per_shard):
+            print(f"shard {shard}: {totals}")
+        print(f"all shards: {overall}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,38 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from starlette.responses import PlainTextResponse
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, date
 from passlib.context import CryptContext
 
-from main import app
+from main import app, rate_buckets, session_store
+from ratelimit import RateLimitMiddleware, SQLiteBuckets
+from sessions import MemorySessionStore, ServerSessionMiddleware, SessionStore, SQLiteSessionStore
 from database import Base
-from models import User, Budget, Expense
-from auth import get_db
+from models import User, Budget, Expense, BudgetAlert, RecurringExpense, Category, ChangeLog, ExpenseArchive, ExpenseRollup
+from crud import DEFAULT_CATEGORIES
+from fx import RateTable
+import alerts
+import analytics
+import archive
+import cache
+import colstore
+import crud
+import database
+import events
+import migrate
+import schemas
+import search
+import shards
+import widgets
+from auth import get_db, get_primary_db, get_session_factory
 
 # Password hashing context
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -29,6 +53,8 @@ def override_get_db():
         db.close()
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_primary_db] = override_get_db
+app.dependency_overrides[get_session_factory] = lambda: TestingSessionLocal
 client = TestClient(app)
 
 class TestExpenseTracker(unittest.TestCase):
@@ -47,6 +73,12 @@ class TestExpenseTracker(unittest.TestCase):
         db.commit()
         db.refresh(test_user)
         cls.test_user_id = test_user.id
+
+        # Give the test user the default categories
+        categories = [Category(user_id=cls.test_user_id, name=name) for name in DEFAULT_CATEGORIES]
+        db.add_all(categories)
+        db.commit()
+        cls.category_ids = {c.name: c.id for c in categories}
         
         # Create a test budget
         test_budget = Budget(
@@ -62,7 +94,7 @@ class TestExpenseTracker(unittest.TestCase):
         test_expense = Expense(
             user_id=cls.test_user_id,
             amount=100.00,
-            category="Food",
+            category_id=cls.category_ids["Food"],
             date=date.today(),
             description="Test expense"
         )
@@ -76,7 +108,13 @@ class TestExpenseTracker(unittest.TestCase):
     def tearDownClass(cls):
         """Clean up after all tests"""
         db = TestingSessionLocal()
+        db.query(ChangeLog).delete()
+        db.query(BudgetAlert).delete()
         db.query(Expense).delete()
+        db.query(ExpenseArchive).delete()
+        db.query(ExpenseRollup).delete()
+        db.query(RecurringExpense).delete()
+        db.query(Category).delete()
         db.query(Budget).delete()
         db.query(User).delete()
         db.commit()
@@ -86,6 +124,10 @@ class TestExpenseTracker(unittest.TestCase):
         """Set up for each test"""
         self.db = TestingSessionLocal()
         self.client = TestClient(app)
+        # Every test logs in again; start each one with full rate limit buckets
+        rate_buckets.clear()
+        # Tests insert rows directly, bypassing the write hooks that keep the store current
+        colstore.clear()
         
         # Simulate login with correct credentials
         response = self.client.post(
@@ -140,6 +182,7 @@ class TestExpenseTracker(unittest.TestCase):
         user = self.db.query(User).filter(User.email == "new@example.com").first()
         self.assertIsNotNone(user)
         self.assertTrue(pwd_context.verify("newpassword", user.password_hash))
+        self.assertEqual(user.shard, 0)
 
     def test_register_existing_user(self):
         response = self.client.post(
@@ -155,6 +198,22 @@ class TestExpenseTracker(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         # self.assertIn(b"Email already registered", response.content)
 
+    def test_login_rate_limited_per_account(self):
+        for _ in range(5):
+            response = self.client.post(
+                "/login",
+                data={"email": "victim@example.com", "password": "guess"},
+                follow_redirects=False
+            )
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            "/login",
+            data={"email": "victim@example.com", "password": "guess"},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("retry-after", response.headers)
+
     def test_dashboard_access(self):
         # Test with valid session
         response = self.client.get(
@@ -180,6 +239,27 @@ class TestExpenseTracker(unittest.TestCase):
         # Verify session is cleared
         self.assertIsNone(response.cookies.get("session"))
 
+    def test_logout_revokes_session(self):
+        self.assertEqual(TestClient(app).get("/api/changes", cookies={"session": self.session_cookie}).status_code, 200)
+        self.client.get("/logout", cookies={"session": self.session_cookie}, follow_redirects=False)
+        # The old cookie no longer maps to a session on the server
+        response = TestClient(app).get("/api/changes", cookies={"session": self.session_cookie})
+        self.assertEqual(response.status_code, 401)
+
+    def test_login_rotates_session_id(self):
+        # A session id known before login (e.g. planted by an attacker) stops working after it
+        session_store.set("planted-id", {"user_id": 0})
+        response = TestClient(app).post(
+            "/login",
+            data={"email": "test@example.com", "password": "testpassword"},
+            cookies={"session": "planted-id"},
+            follow_redirects=False
+        )
+        rotated = response.cookies.get("session")
+        self.assertNotIn(rotated, (None, "planted-id"))
+        self.assertIsNone(session_store.get("planted-id"))
+        self.assertEqual(TestClient(app).get("/api/changes", cookies={"session": rotated}).status_code, 200)
+
     def test_add_budget(self):
         response = self.client.post(
             "/add-budget",
@@ -288,7 +368,7 @@ class TestExpenseTracker(unittest.TestCase):
         expense = Expense(
             user_id=self.test_user_id,
             amount=75.00,
-            category="Entertainment",
+            category_id=self.category_ids["Entertainment"],
             date=date.today(),
             description="Expense to delete"
         )
@@ -305,10 +385,422 @@ class TestExpenseTracker(unittest.TestCase):
         self.assertEqual(response.status_code, 303)
         self.assertEqual(response.headers["location"], "/view-expenses")
 
-        # Verify expense was deleted
+        # Verify expense was deleted (soft delete keeps the row out of live queries)
+        self.db.expire_all()
         expense = self.db.query(Expense).filter(
             Expense.id == expense_id
         ).first()
+        self.assertIsNotNone(expense.deleted_at)
+
+    def test_dashboard_partial_render_on_slow_widget(self):
+        def slow_summary(db, user_id, today):
+            time.sleep(0.5)
+            return {}
+
+        with mock.patch.dict(widgets.WIDGETS, {"month_summary": slow_summary}), \
+                mock.patch.object(widgets, "LATENCY_BUDGET", 0.1):
+            response = self.client.get("/dashboard", cookies={"session": self.session_cookie})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Category breakdown is taking longer", response.content)
+        self.assertIn(b"Recent Expenses", response.content)
+        self.assertNotIn(b"Recent expenses are taking longer", response.content)
+
+    def test_expense_event_published(self):
+        async def scenario():
+            queue = events.subscribe(self.test_user_id)
+            try:
+                expense = schemas.ExpenseCreate(
+                    amount=30.0, category="Transport", date=date(2031, 5, 4), description="Cab"
+                )
+                await asyncio.to_thread(crud.create_expense, self.db, self.test_user_id, expense)
+                return await asyncio.wait_for(queue.get(), 5)
+            finally:
+                events.unsubscribe(self.test_user_id, queue)
+
+        event = asyncio.run(scenario())
+        self.assertEqual(event["type"], "expense")
+        self.assertEqual(
+            events._format(event, "INR"),
+            'event: expense\ndata: {"deltas": [{"month": "May", "category": "Transport", "amount": 30.0}]}\n\n'
+        )
+        self.assertFalse(events.has_subscribers(self.test_user_id))
+
+    def test_change_feed(self):
+        start = self.client.get("/api/changes", cookies={"session": self.session_cookie}).json()
+        while start["more"]:
+            start = self.client.get(
+                f"/api/changes?since={start['next']}", cookies={"session": self.session_cookie}
+            ).json()
+        self.client.post(
+            "/add-expense",
+            data={"month": "April", "amount": "12.00", "category": "Food", "date": "2031-04-02",
+                  "description": "Synced lunch"},
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        expense = self.db.query(Expense).filter(Expense.description == "Synced lunch").first()
+        self.client.get(
+            f"/delete-expense/{expense.id}", cookies={"session": self.session_cookie}, follow_redirects=False
+        )
+
+        response = self.client.get(
+            f"/api/changes?since={start['next']}", cookies={"session": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        feed = response.json()
+        self.assertEqual([(c["op"], c["id"]) for c in feed["changes"]], [("upsert", expense.id), ("delete", expense.id)])
+        self.assertEqual(feed["changes"][0]["data"]["amount"], 12.0)
+        self.assertEqual(feed["next"], feed["changes"][-1]["seq"])
+
+    def test_change_feed_requires_login(self):
+        response = TestClient(app).get("/api/changes")
+        self.assertEqual(response.status_code, 401)
+
+    def test_archive_old_expenses(self):
+        for amount, deleted_at in ((40.00, None), (99.00, datetime(2001, 1, 1))):
+            self.db.add(Expense(
+                user_id=self.test_user_id,
+                amount=amount,
+                category_id=self.category_ids["Shopping"],
+                date=date(2001, 2, 3),
+                description="Ancient purchase",
+                deleted_at=deleted_at
+            ))
+        self.db.commit()
+
+        self.assertEqual(archive.archive_before(self.db, date(2002, 1, 1)), 2)
+        self.assertEqual(self.db.query(Expense).filter(Expense.date < date(2002, 1, 1)).count(), 0)
+        rollup = self.db.query(ExpenseRollup).filter(ExpenseRollup.user_id == self.test_user_id).one()
+        self.assertEqual((rollup.year, rollup.month, rollup.total, rollup.count), (2001, 2, 40.00, 1))
+
+        response = self.client.get(
+            "/view-expenses?month_filter=February&include_archive=true",
+            cookies={"session": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Ancient purchase", response.content)
+        response = self.client.get(
+            "/view-expenses?month_filter=February",
+            cookies={"session": self.session_cookie}
+        )
+        self.assertNotIn(b"Ancient purchase", response.content)
+
+    def test_budget_alert_on_overspend(self):
+        # Budget for a month no other test writes to
+        budget = Budget(user_id=self.test_user_id, month="December", year=2030, amount=200.00)
+        self.db.add(budget)
+        self.db.commit()
+
+        response = self.client.post(
+            "/add-expense",
+            data={
+                "month": "December",
+                "amount": "170.00",
+                "category": "Shopping",
+                "date": "2030-12-10",
+                "description": "Gifts"
+            },
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 303)
+
+        thresholds = [a.threshold for a in self.db.query(BudgetAlert).filter(
+            BudgetAlert.user_id == self.test_user_id,
+            BudgetAlert.year == 2030,
+            BudgetAlert.month == 12
+        )]
+        self.assertEqual(thresholds, [80])
+
+    def test_alert_state_kept_across_other_months(self):
+        budget = Budget(user_id=self.test_user_id, month="November", year=2030, amount=1000.00)
+        self.db.add(budget)
+        self.db.commit()
+
+        def add(day, amount):
+            crud.create_expense(self.db, self.test_user_id, schemas.ExpenseCreate(
+                month="November", amount=amount, category="Food", date=day, description="Lunch"
+            ))
+
+        add(date(2030, 11, 2), 100.00)
+        # A write in another month must not force November to reload
+        add(date(2030, 10, 2), 50.00)
+        with mock.patch.object(alerts, "_load", side_effect=AssertionError("reloaded")):
+            add(date(2030, 11, 3), 25.00)
+            status = alerts.month_status(
+                self.db, self.test_user_id, cache.versions.get(self.test_user_id), 2030, 11
+            )
+        self.assertEqual(status["spent"], 125.00)
+
+    def test_spending_outlook(self):
+        # Steady daily spend through February and March 2003 with one spike on March 15
+        amounts = {}
+        for ordinal in range(date(2003, 2, 1).toordinal(), date(2003, 4, 1).toordinal()):
+            day = date.fromordinal(ordinal)
+            amounts[day] = 200.00 if day == date(2003, 3, 15) else 10.00 + day.day % 3
+        self.db.add_all(
+            Expense(user_id=self.test_user_id, amount=amount, category_id=self.category_ids["Food"],
+                    date=day, description="Groceries")
+            for day, amount in amounts.items()
+        )
+        self.db.commit()
+        march = sum(amount for day, amount in amounts.items() if day.month == 3)
+
+        outlook = analytics.get_outlooks(
+            self.db, self.test_user_id, cache.versions.get(self.test_user_id), [(2003, 3)], date(2003, 4, 2)
+        )[(2003, 3)]
+        self.assertAlmostEqual(outlook["projected"], march)
+        self.assertEqual([day for day, _, _ in outlook["anomalies"]], [date(2003, 3, 15)])
+
+        # Mid-month: the first ten days' run rate fills the rest of the month
+        first_ten = sum(amounts[date(2003, 3, d)] for d in range(1, 11))
+        outlook = analytics.get_outlooks(
+            self.db, self.test_user_id, cache.versions.get(self.test_user_id), [(2003, 3)], date(2003, 3, 10)
+        )[(2003, 3)]
+        self.assertAlmostEqual(outlook["projected"], march + first_ten / 10 * 21)
+
+        # A new expense patches the loaded series instead of querying again
+        crud.create_expense(self.db, self.test_user_id, schemas.ExpenseCreate(
+            date=date(2003, 3, 20), amount=500.00, category="Food", description="Party"
+        ))
+        with mock.patch.object(analytics, "_load", side_effect=AssertionError("reloaded")):
+            outlook = analytics.get_outlooks(
+                self.db, self.test_user_id, cache.versions.get(self.test_user_id), [(2003, 3)], date(2003, 4, 2)
+            )[(2003, 3)]
+        self.assertAlmostEqual(outlook["projected"], march + 500.00)
+        self.assertIn(date(2003, 3, 20), [day for day, _, _ in outlook["anomalies"]])
+
+        response = self.client.get("/view-budgets", cookies={"session": self.session_cookie})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Projected month-end", response.content)
+
+    def test_spending_outlook_loaded_during_write(self):
+        # The series is loaded after the write commits but before it bumps the version
+        def load_then_bump(user_id):
+            analytics.get_outlooks(self.db, user_id, cache.versions.get(user_id), [(2005, 7)], date(2005, 8, 1))
+            return cache.user_changed(user_id)
+
+        with mock.patch.object(crud, "user_changed", load_then_bump):
+            crud.create_expense(self.db, self.test_user_id, schemas.ExpenseCreate(
+                date=date(2005, 7, 4), amount=100.00, category="Food", description="Picnic"
+            ))
+        outlook = analytics.get_outlooks(
+            self.db, self.test_user_id, cache.versions.get(self.test_user_id), [(2005, 7)], date(2005, 8, 1)
+        )[(2005, 7)]
+        self.assertAlmostEqual(outlook["projected"], 100.00)
+
+    def test_column_store_patched_on_write(self):
+        # Reads go to the database until the user has read often enough
+        with mock.patch.object(colstore, "ADMIT_AFTER_READS", 2):
+            database_rows = crud.get_expenses(self.db, self.test_user_id)
+            self.assertIsInstance(database_rows[0], crud.ExpenseSnapshot)
+            self.assertEqual(len(colstore._stores), 0)
+            self.assertEqual(crud.get_expenses_by_month(self.db, self.test_user_id, "June"), [])
+            self.assertEqual(len(colstore._stores), 1)
+        # Same rows, same type, with and without the store
+        self.assertEqual(crud.get_expenses(self.db, self.test_user_id), database_rows)
+        created = crud.create_expense(self.db, self.test_user_id, schemas.ExpenseCreate(
+            date=date(2031, 6, 9), amount=12.00, category="Shopping", description="Columns"
+        ))
+        # Served from the patched arrays, not reloaded
+        with mock.patch.object(colstore, "_load", side_effect=AssertionError("reloaded")):
+            june = crud.get_expenses_by_month(self.db, self.test_user_id, "June")
+            self.assertEqual([(e.id, e.amount, e.description) for e in june], [(created.id, 12.00, "Columns")])
+            self.assertEqual(crud._category_totals_by_id(self.db, self.test_user_id, "June"),
+                             {self.category_ids["Shopping"]: 12.00})
+            crud.delete_expense(self.db, created.id, self.test_user_id)
+            self.assertEqual(crud.get_expenses_by_month(self.db, self.test_user_id, "June"), [])
+
+        # A store over the memory cap is used for the request but not kept
+        colstore.clear()
+        with mock.patch.object(colstore._stores, "maxbytes", 1), \
+                mock.patch.object(colstore, "ADMIT_AFTER_READS", 1), \
+                mock.patch.object(colstore, "_load", wraps=colstore._load) as load:
+            crud.get_expenses(self.db, self.test_user_id)
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(len(colstore._stores), 0)
+
+    def test_search_expenses(self):
+        response = self.client.get(
+            "/search",
+            params={"q": "test exp", "category": "Food"},
+            cookies={"session": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"1 matching expense", response.content)
+
+        response = self.client.get(
+            "/search",
+            params={"q": "nosuchword"},
+            cookies={"session": self.session_cookie}
+        )
+        self.assertIn(b"0 matching expenses", response.content)
+
+    def test_search_while_index_is_patched(self):
+        user_id = 10 ** 9  # no such user; the index is planted
+        index = search.ExpenseIndex(0, [(i, f"item {i}", 1, date(2024, 1, 1)) for i in range(5000)])
+        with mock.patch.object(search, "_build", return_value=index):
+            search.get_index(self.db, user_id, 0)
+        done = threading.Event()
+
+        def write():
+            version = 0
+            while not done.is_set():
+                row = crud.ExpenseSnapshot(5000 + version % 100, date(2024, 1, 2), 1.0, "INR", 1, "item new")
+                search.expense_written(user_id, version + 1, after=row)
+                search.expense_written(user_id, version + 2, before=row)
+                version += 2
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(200):
+                self.assertGreaterEqual(len(index.search("item")), 5000)
+                self.assertGreaterEqual(len(index.search()), 5000)
+        finally:
+            done.set()
+            writer.join()
+            search.expense_written(user_id, -1)  # stale: drops the index
+
+    def test_recurring_expense_materialized(self):
+        response = self.client.post(
+            "/add-recurring",
+            data={
+                "amount": "500.00",
+                "category": "Utilities",
+                "frequency": "weekly",
+                "interval": "1",
+                "start_date": "2020-01-01",
+                "end_date": "2020-01-29",
+                "description": "Cleaner"
+            },
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 303)
+
+        rule = self.db.query(RecurringExpense).filter(
+            RecurringExpense.user_id == self.test_user_id,
+            RecurringExpense.description == "Cleaner"
+        ).first()
+        self.assertIsNone(rule.next_date)
+        dates = [e.date for e in self.db.query(Expense).filter(Expense.recurring_id == rule.id)]
+        self.assertEqual(sorted(dates), [date(2020, 1, d) for d in (1, 8, 15, 22, 29)])
+
+    def test_add_category(self):
+        response = self.client.post(
+            "/add-category",
+            data={"name": "Travel"},
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 303)
+
+        response = self.client.post(
+            "/add-expense",
+            data={
+                "month": "March",
+                "amount": "300.00",
+                "category": "Travel",
+                "date": "2031-03-01",
+                "description": "Train tickets"
+            },
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 303)
+        expense = self.db.query(Expense).filter(Expense.description == "Train tickets").first()
+        category = self.db.query(Category).filter(Category.id == expense.category_id).first()
+        self.assertEqual(category.name, "Travel")
+
+    def test_add_expense_double_submit(self):
+        form = {
+            "month": "April",
+            "amount": "42.00",
+            "category": "Food",
+            "date": "2031-04-02",
+            "description": "Submitted twice",
+            "idempotency_key": "form-key-1"
+        }
+        for _ in range(2):
+            response = self.client.post(
+                "/add-expense", data=form, cookies={"session": self.session_cookie}, follow_redirects=False
+            )
+            self.assertEqual(response.status_code, 303)
+            version = cache.versions.get(self.test_user_id)
+        self.assertEqual(self.db.query(Expense).filter(Expense.description == "Submitted twice").count(), 1)
+        # The retry changed nothing, so cached aggregates stay valid
+        self.assertEqual(cache.versions.get(self.test_user_id), version)
+
+    def test_api_expenses_batch_retry(self):
+        batch = [
+            {"date": "2031-05-01", "amount": 5.00, "category": "Transport", "description": "Batch bus"},
+            {"date": "2031-05-02", "amount": 7.50, "category": "Food", "description": "Batch lunch"},
+        ]
+        headers = {"Idempotency-Key": "batch-key-1"}
+        first = self.client.post(
+            "/api/expenses", json=batch, headers=headers, cookies={"session": self.session_cookie}
+        )
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(first.json()["expenses"]), 2)
+
+        # Also when the key is no longer in memory (another worker, or expired)
+        crud._recent_keys.clear()
+        retry = self.client.post(
+            "/api/expenses", json=batch, headers=headers, cookies={"session": self.session_cookie}
+        )
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(self.db.query(Expense).filter(Expense.description.like("Batch %")).count(), 2)
+
+        # Rows deleted since are not echoed back, nor created again
+        crud.delete_expense(self.db, first.json()["expenses"][0]["id"], self.test_user_id)
+        retry = self.client.post(
+            "/api/expenses", json=batch, headers=headers, cookies={"session": self.session_cookie}
+        )
+        self.assertEqual(retry.json()["expenses"], first.json()["expenses"][1:])
+        self.assertEqual(self.db.query(Expense).filter(Expense.description.like("Batch %")).count(), 2)
+
+    def test_add_expense_unknown_category(self):
+        response = self.client.post(
+            "/add-expense",
+            data={
+                "month": "March",
+                "amount": "10.00",
+                "category": "NoSuchCategory",
+                "date": "2031-03-02"
+            },
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_expense_unknown_currency(self):
+        response = self.client.post(
+            "/add-expense",
+            data={
+                "month": "March",
+                "amount": "10.00",
+                "category": "Food",
+                "currency": "XYZ",
+                "date": "2031-03-02"
+            },
+            cookies={"session": self.session_cookie},
+            follow_redirects=False
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_convert_grouped(self):
+        rates = RateTable([
+            (date(2030, 1, 1), "USD", 80.0),
+            (date(2030, 6, 1), "USD", 90.0),
+        ])
+        totals = rates.convert_grouped([
+            ("Food", "INR", date(2030, 3, 1), 100.0),
+            ("Food", "USD", date(2030, 3, 1), 1.0),
+            ("Travel", "USD", date(2030, 7, 1), 2.0),
+        ], "INR")
+        self.assertEqual(totals, {"Food": 180.0, "Travel": 180.0})
+        self.assertEqual(rates.convert_grouped([("Food", "INR", date(2030, 7, 1), 90.0)], "USD"), {"Food": 1.0})
 
     def test_summary_page(self):
         response = self.client.get(
@@ -319,5 +811,278 @@ class TestExpenseTracker(unittest.TestCase):
         # self.assertIn(b"summary.html", response.content)
         # self.assertIn(b"Food", response.content)
 
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "versions.db")
+        # Two workers sharing one counter file
+        self.first, self.second = cache.SQLiteVersions(path), cache.SQLiteVersions(path)
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        self.directory.cleanup()
+
+    def test_sqlite_versions_shared_between_connections(self):
+        self.assertEqual(self.second.get(42), 0)
+        self.assertEqual(self.first.bump(42), 1)
+        self.assertEqual(self.second.bump(42), 2)
+        self.assertEqual(self.first.get(42), 2)
+        self.assertEqual(self.second.get_many([42, 43]), {42: 2, 43: 0})
+
+    def test_user_cache_recomputes_after_write_in_other_worker(self):
+        values = iter(["first", "second"])
+        user_cache = cache.UserCache()
+        with mock.patch.object(cache, "versions", self.first):
+            self.assertEqual(user_cache.get_or_compute(42, "key", lambda: next(values)), "first")
+            self.assertEqual(user_cache.get_or_compute(42, "key", lambda: next(values)), "first")
+            self.second.bump(42)
+            self.assertEqual(user_cache.get_or_compute(42, "key", lambda: next(values)), "second")
+
+    def test_user_states_patch_drop_and_evict(self):
+        class State:
+            def __init__(self, version, nbytes):
+                self.version, self.nbytes, self.lock = version, nbytes, threading.Lock()
+
+        states = cache.UserStates(maxbytes=100, sizeof=lambda state: state.nbytes)
+        states.put(1, State(5, 40))
+        states.put(2, State(7, 40))
+        # One version behind: patched in place
+        states.patch(1, 6, lambda state: setattr(state, "nbytes", 50))
+        self.assertEqual(states.get(1, 6).nbytes, 50)
+        self.assertIsNone(states.get(1, 5))
+        # A write made elsewhere was missed: dropped
+        states.patch(2, 9, lambda state: self.fail("patched a stale state"))
+        self.assertIsNone(states.get(2, 7))
+        self.assertEqual(states.total_bytes, 50)
+        # Over budget: least recently used goes first
+        states.put(3, State(1, 40))
+        states.put(4, State(1, 40))
+        self.assertEqual((len(states), states.total_bytes), (2, 80))
+        self.assertIsNone(states.get(1, 6))
+
+    def test_recent_keys_expire(self):
+        keys = cache.RecentKeys(ttl=60)
+        with mock.patch("cache.time.monotonic", return_value=1000.0):
+            keys.put("a", [1])
+        with mock.patch("cache.time.monotonic", return_value=1059.0):
+            self.assertEqual(keys.get("a"), [1])
+        with mock.patch("cache.time.monotonic", return_value=1060.0):
+            self.assertIsNone(keys.get("a"))
+            # Writes drop expired entries from the front
+            keys.put("b", [2])
+        self.assertEqual(list(keys._entries), ["b"])
+
+
+class TestMigrations(unittest.TestCase):
+    def test_upgrade_from_baseline_schema(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        engine = create_engine(f"sqlite:///{os.path.join(directory.name, 'old.db')}")
+        self.addCleanup(engine.dispose)
+        # The schema the app shipped with, before migrate.py existed
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, "
+                "email VARCHAR(100) NOT NULL UNIQUE, password_hash VARCHAR(255) NOT NULL)"
+            ))
+            conn.execute(text(
+                "CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users(id), "
+                "amount FLOAT NOT NULL, category VARCHAR(50) NOT NULL, date DATE NOT NULL, description VARCHAR(200))"
+            ))
+            conn.execute(text(
+                "CREATE TABLE budgets (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users(id), "
+                "month VARCHAR(20) NOT NULL, year INTEGER NOT NULL, amount FLOAT NOT NULL, "
+                "CONSTRAINT uix_user_month_year UNIQUE (user_id, month, year))"
+            ))
+            conn.execute(text("INSERT INTO users VALUES (1, 'Old', 'old@example.com', 'x')"))
+            conn.execute(text("INSERT INTO expenses VALUES (1, 1, 40.0, 'Gym', '2020-05-01', 'Membership')"))
+
+        self.assertEqual(migrate.upgrade(engine), (1, migrate.LATEST_VERSION))
+
+        tables = inspect(engine)
+        for table in Base.metadata.sorted_tables:
+            self.assertTrue(
+                {column.name for column in table.columns} <= {c["name"] for c in tables.get_columns(table.name)},
+                table.name
+            )
+        self.assertNotIn("category", {c["name"] for c in tables.get_columns("recurring_expenses")})
+        with engine.connect() as conn:
+            name = conn.execute(text(
+                "SELECT c.name FROM expenses e JOIN categories c ON c.id = e.category_id WHERE e.id = 1"
+            )).scalar()
+        self.assertEqual(name, "Gym")
+        # Nothing left to apply
+        self.assertEqual(migrate.upgrade(engine), (migrate.LATEST_VERSION, migrate.LATEST_VERSION))
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        urls = [f"sqlite:///{os.path.join(directory.name, f'shard{i}.db')}" for i in range(2)]
+        self.versions_path = os.path.join(directory.name, "versions.db")
+        self.versions = cache.SQLiteVersions(self.versions_path)
+        self.addCleanup(self.versions.close)
+        for patcher in (
+            mock.patch.object(database, "SHARD_URLS", urls),
+            mock.patch.dict(database._engines, clear=True),
+            mock.patch.dict(database._sessionmakers, clear=True),
+            mock.patch.dict(database._routes, clear=True),
+            mock.patch.object(cache, "versions", self.versions),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(database.dispose_engine)
+        for shard in range(2):
+            Base.metadata.create_all(bind=database.get_engine(shard))
+
+        primary = database.open_session(0)
+        self.addCleanup(primary.close)
+        # The first user gets id 1, which assign_shard puts on shard 1
+        self.user_id = crud.create_user(primary, schemas.UserCreate(
+            name="Sharded", email="sharded@example.com", password="password123"
+        )).id
+        self.assertEqual(database.shard_for(self.user_id), 1)
+
+    def _set_shard(self, shard):
+        # What `shards.py move` does to the primary from another process
+        with database.get_engine(0).begin() as conn:
+            conn.execute(text("UPDATE users SET shard = :shard WHERE id = :id"), {"shard": shard, "id": self.user_id})
+
+    def test_route_cached_until_version_bumped_elsewhere(self):
+        self._set_shard(0)
+        self.assertEqual(database.shard_for(self.user_id), 1)
+        other_worker = cache.SQLiteVersions(self.versions_path)
+        self.addCleanup(other_worker.close)
+        other_worker.bump(self.user_id)
+        self.assertEqual(database.shard_for(self.user_id), 0)
+
+    def test_route_not_cached_without_shared_versions(self):
+        with mock.patch.object(cache, "versions", cache.LocalVersions()):
+            self.assertEqual(database.shard_for(self.user_id), 1)
+            self._set_shard(0)
+            self.assertEqual(database.shard_for(self.user_id), 0)
+            with self.assertRaises(ValueError):
+                shards.move_user(self.user_id, 1)
+
+    def test_move_user(self):
+        source = database.open_session(1)
+        self.addCleanup(source.close)
+        food = source.query(Category).filter(Category.user_id == self.user_id, Category.name == "Food").one()
+        source.add(Budget(user_id=self.user_id, month="March", year=2024, amount=500.00))
+        source.add(Expense(user_id=self.user_id, amount=42.00, category_id=food.id,
+                           date=date(2024, 3, 5), description="Moved lunch"))
+        source.commit()
+        version = self.versions.get(self.user_id)
+
+        self.assertEqual(shards.move_user(self.user_id, 0), 1)
+
+        self.assertEqual(database.shard_for(self.user_id), 0)
+        self.assertGreater(self.versions.get(self.user_id), version)
+        self.assertIsNone(source.query(Expense).filter(Expense.user_id == self.user_id).first())
+        self.assertIsNone(source.query(User).filter(User.id == self.user_id).first())
+        target = database.open_session(0)
+        self.addCleanup(target.close)
+        expense = target.query(Expense).filter(Expense.user_id == self.user_id).one()
+        self.assertEqual((expense.amount, expense.description), (42.00, "Moved lunch"))
+        self.assertEqual(target.get(Category, expense.category_id).name, "Food")
+        self.assertEqual(
+            sorted(entry.entity for entry in target.query(ChangeLog).filter(ChangeLog.user_id == self.user_id)),
+            ["budget", "expense"]
+        )
+        # Writes through the old shard's session are refused
+        with self.assertRaises(database.ShardMovedError):
+            database.check_shard(source, self.user_id)
+
+
+class TestRateLimitBuckets(unittest.TestCase):
+    def test_sqlite_buckets_taken_off_the_event_loop(self):
+        threads = {}
+
+        async def endpoint(scope, receive, send):
+            threads["loop"] = threading.get_ident()
+            await PlainTextResponse("ok")(scope, receive, send)
+
+        with tempfile.TemporaryDirectory() as directory:
+            buckets = SQLiteBuckets(os.path.join(directory, "ratelimit.db"))
+            take = buckets.take
+
+            def recording_take(key, limit):
+                threads["take"] = threading.get_ident()
+                return take(key, limit)
+
+            try:
+                with mock.patch.object(buckets, "take", recording_take):
+                    response = TestClient(RateLimitMiddleware(endpoint, buckets)).post("/add-expense")
+            finally:
+                buckets.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(threads["take"], threads["loop"])
+
+
+class TestSessionStores(unittest.TestCase):
+    def test_memory_store_expires_after_ttl(self):
+        store = MemorySessionStore(ttl=10)
+        with mock.patch("sessions.time.monotonic", return_value=100.0):
+            store.set("a", {"user_id": 1})
+        with mock.patch("sessions.time.monotonic", return_value=105.0):
+            self.assertEqual(store.get("a"), {"user_id": 1})  # also slides the expiry to 115
+        with mock.patch("sessions.time.monotonic", return_value=114.0):
+            self.assertEqual(store.get("a"), {"user_id": 1})
+        with mock.patch("sessions.time.monotonic", return_value=200.0):
+            self.assertIsNone(store.get("a"))
+
+    def test_memory_store_evicts_least_recently_used(self):
+        store = MemorySessionStore(max_entries=2)
+        store.set("a", {"n": 1})
+        store.set("b", {"n": 2})
+        store.get("a")
+        store.set("c", {"n": 3})
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.get("a"), {"n": 1})
+        self.assertEqual(store.get("c"), {"n": 3})
+
+    def test_sqlite_store_shared_between_instances(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sessions.db")
+            first, second = SQLiteSessionStore(path, ttl=10), SQLiteSessionStore(path, ttl=10)
+            try:
+                with mock.patch("sessions.time.time", return_value=1000.0):
+                    first.set("a", {"user_id": 7})
+                    self.assertEqual(second.get("a"), {"user_id": 7})
+                    second.delete("a")
+                    self.assertIsNone(first.get("a"))
+                    first.set("b", {"user_id": 8})
+                with mock.patch("sessions.time.time", return_value=1011.0):
+                    self.assertIsNone(second.get("b"))
+            finally:
+                first.close()
+                second.close()
+
+    def test_cookie_max_age_refreshed_on_reads(self):
+        async def endpoint(scope, receive, send):
+            if scope["path"] == "/login":
+                scope["session"]["user_id"] = 1
+            await PlainTextResponse("ok")(scope, receive, send)
+
+        client = TestClient(ServerSessionMiddleware(endpoint, MemorySessionStore(), max_age=100))
+        with mock.patch("sessions.time.time", return_value=1000.0):
+            session_id = client.get("/login").cookies["session"]
+        # More than half of the Max-Age left: nothing to re-issue
+        with mock.patch("sessions.time.time", return_value=1040.0):
+            self.assertNotIn("set-cookie", client.get("/", cookies={"session": session_id}).headers)
+        with mock.patch("sessions.time.time", return_value=1060.0):
+            cookie = client.get("/", cookies={"session": session_id}).headers["set-cookie"]
+        self.assertIn(f"session={session_id};", cookie)
+        self.assertIn("Max-Age=100;", cookie)
+        with mock.patch("sessions.time.time", return_value=1100.0):
+            self.assertNotIn("set-cookie", client.get("/", cookies={"session": session_id}).headers)
+
+    def test_session_store_is_abstract(self):
+        with self.assertRaises(TypeError):
+            SessionStore()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
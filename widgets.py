@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from sqlalchemy.orm import Session
+
+import alerts
+import cache
+import crud
+
+logger = logging.getLogger(__name__)
+
+# Total time the page waits for its widgets; slower ones render as unavailable
+LATENCY_BUDGET = float(os.getenv("DASHBOARD_LATENCY_BUDGET", "0.5"))
+
+# Caps the DB connections the dashboard can hold at once across all requests
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DASHBOARD_WORKERS", "8")), thread_name_prefix="dashboard"
+)
+
+# name -> fn(db, user_id, today); filled by the @widget decorator
+WIDGETS = {}
+
+
+def widget(name: str):
+    """Register an independent dashboard query; it gets its own session and thread"""
+    def register(fn):
+        WIDGETS[name] = fn
+        return fn
+    return register
+
+
+@widget("month_status")
+def _month_status(db: Session, user_id: int, today: date):
+    return alerts.month_status(db, user_id, cache.versions.get(user_id), today.year, today.month)
+
+
+@widget("alerts")
+def _alerts(db: Session, user_id: int, today: date):
+    return alerts.recent_alerts(db, user_id, limit=5)
+
+
+@widget("month_summary")
+def _month_summary(db: Session, user_id: int, today: date):
+    return crud.get_monthly_summary(db, user_id, today.strftime("%B"))
+
+
+@widget("recent_expenses")
+def _recent_expenses(db: Session, user_id: int, today: date):
+    expenses = crud.get_recent_expenses(db, user_id)
+    names = crud.get_category_names(db, user_id, {e.category_id for e in expenses})
+    return [(expense, names[expense.category_id]) for expense in expenses]
+
+
+def _run(session_factory, fn, user_id, today):
+    db = session_factory()
+    try:
+        return fn(db, user_id, today)
+    finally:
+        db.close()
+
+
+def _discard(future):
+    # Collect the outcome of widgets that finished after the page was sent
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Late dashboard widget failed: %r", future.exception())
+
+
+async def gather(session_factory, user_id: int, today: date, budget: float = None):
+    """Run every widget concurrently; returns ({name: result}, [names that missed the budget or failed]).
+
+    Each widget gets its own session from `session_factory` (auth.get_session_factory).
+    """
+    loop = asyncio.get_running_loop()
+    futures = {
+        name: loop.run_in_executor(_executor, _run, session_factory, fn, user_id, today)
+        for name, fn in WIDGETS.items()
+    }
+    done, pending = await asyncio.wait(
+        futures.values(), timeout=LATENCY_BUDGET if budget is None else budget
+    )
+    for future in pending:
+        future.add_done_callback(_discard)
+
+    results, missing = {}, []
+    for name, future in futures.items():
+        if future in done and future.exception() is None:
+            results[name] = future.result()
+        else:
+            if future in done:
+                logger.error("Dashboard widget %s failed", name, exc_info=future.exception())
+            missing.append(name)
+    return results, missing